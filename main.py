@@ -14,12 +14,6 @@ import time
 import h5py
 import cProfile
 
-from mpi4py import MPI
-
-# MPI 多进程通信
-comm = MPI.COMM_WORLD
-# 主进程
-rank = comm.rank
 from scipy import linalg
 
 import matplotlib
@@ -30,6 +24,7 @@ import pylab
 
 from truncated_GMM import TruncatedGaussianMixture as GMM
 from utils.data import get_data
+from utils.comm import get_comm, run_pool
 import utils.coreset as cs
 
 # changed place :
@@ -48,6 +43,18 @@ params = {
     'Ninit': 5,
     'dataset': 'BIRCH2-400',
     'VERBOSE': True,
+    'comm': 'auto',
+    'n_procs': 1,
+    'chunk_size': None,
+    'max_block_bytes': 2 ** 27,
+    'backend': 'numpy',
+    'n_threads': 1,
+    'prune': False,
+    'neighbor_tol': None,
+    'tol_fe': None,
+    'tol_K': None,
+    'tol_drift': None,
+    'rebalance_tol': None,
 }
 
 
@@ -69,7 +76,14 @@ params['Cprime'] = int(params['Cprime'])
 params['G'] = int(params['G'])
 params['Niter'] = int(params['Niter'])
 params['Ninit'] = int(params['Ninit'])
+params['n_procs'] = int(params['n_procs'])
+params['chunk_size'] = None if params['chunk_size'] in [None, 'None'] else int(params['chunk_size'])
+params['max_block_bytes'] = int(params['max_block_bytes'])
+params['n_threads'] = int(params['n_threads'])
 params['VERBOSE'] = True if (params['VERBOSE'] == True or params['VERBOSE'] == 'True') else False
+params['prune'] = True if (params['prune'] == True or params['prune'] == 'True') else False
+for tol in ['neighbor_tol', 'tol_fe', 'tol_K', 'tol_drift', 'rebalance_tol']:
+    params[tol] = None if params[tol] in [None, 'None'] else float(params[tol])
 
 # define the outputs
 if params['VERBOSE']:
@@ -91,8 +105,16 @@ else:
         'np': np.inf,
     }
 
+# ===== Set Up Communication =====================
+# 'auto': MPI if started with mpiexec, a single process otherwise
+# 'pool': fit with n_procs local processes (no MPI needed)
+# 多进程通信
+comm = get_comm(params['comm'] if params['comm'] != 'pool' else 'serial')
+# 主进程
+rank = comm.rank
+
 # ===== Instantiate Model ========================
-gmm = GMM(params)
+gmm = GMM(params, comm)
 
 # ===== Load Data ================================
 # X: data
@@ -117,6 +139,10 @@ c.load_data(X, Y)
 # construct coreset by user definition
 # c.construct(50000)
 
+# construct coreset by all processes, each process samples from its own rows
+# and keeps its part of the coreset (fit with gmm.fit_weight(Xc, Yc, weight=c.weight, distributed=True))
+# c.construct(50000, comm=comm)
+
 # get coreset data and label(if exists)
 Xc = c.coreset
 Yc = c.coreset_label
@@ -223,7 +249,16 @@ else:
 # json.dump({"coreset" : False}, open(filename + "_parameters.txt", 'a'))
 
 # fit model using coreset
-gmm.fit(Xc, Yc, filename=filename, origin_X=X, plot=True)
+def fit_pool(comm, Xc, Yc, filename, X):
+    gmm = GMM(params, comm)
+    gmm.fit(Xc, Yc, filename=filename, origin_X=X, plot=True)
+    return gmm
+
+
+if params['comm'] == 'pool':
+    gmm = run_pool(fit_pool, params['n_procs'], Xc, Yc, filename, X)
+else:
+    gmm.fit(Xc, Yc, filename=filename, origin_X=X, plot=True)
 
 # ===== Output Results ===========================
 if rank == 0:
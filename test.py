@@ -8,6 +8,7 @@ from sklearn.cluster import KMeans
 import matplotlib.pyplot as plt
 
 import utils.coreset as cs
+from utils.data import load_text
 from truncated_GMM import TruncatedGaussianMixture as GMM
 from sklearn.mixture import GaussianMixture as TGMM
 
@@ -169,7 +170,7 @@ CIFAR = unpickle("dataset/train")
 # X = np.loadtxt("dataset/birch1.txt")
 c = cs.Coreset("dataset/birch1.txt")
 # c.load_data(CIFAR[b'data'], CIFAR[b'fine_labels'])
-c.load_UDF(np.loadtxt)
+c.load_UDF(load_text)
 # c.construct(cluster=100, delta=0.1, epsilon=0.1)
 c.construct(10000)
 X = c.data
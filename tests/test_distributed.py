@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('kmc2')
+
+from truncated_GMM import TruncatedGaussianMixture as GMM
+from utils.comm import run_pool
+from utils.coreset import Coreset
+
+BIRCH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dataset', 'birch1.txt')
+VERBOSE = {'ll': True, 'fe': True, 'qe': True, 'cs': True, 'nd': True, 'np': np.inf}
+
+
+def _data(n_samples):
+    return np.loadtxt(BIRCH, max_rows=n_samples) / 10000.
+
+
+def _fit_distributed(comm, X, rows, algorithm):
+    # same seed for the processes with the same data
+    np.random.seed(comm.rank)
+    my_X = X[rows[comm.rank]]
+    gmm = GMM({'algorithm': algorithm, 'C': 10, 'Cprime': 3, 'G': 4, 'Niter': 3, 'Ninit': 1,
+               'VERBOSE': dict(VERBOSE)}, comm)
+    gmm.fit_weight(my_X, np.zeros(my_X.shape[0], dtype=int), weight=np.ones(my_X.shape[0]), distributed=True)
+    return gmm
+
+
+@pytest.mark.parametrize('algorithm', ['var-GMM-X', 'var-GMM-S'])
+def test_fit_with_empty_process(algorithm):
+    X = _data(600)
+    full = run_pool(_fit_distributed, 2, X, [slice(0, 300), slice(300, 600)], algorithm)
+    # the third process has no data points
+    empty = run_pool(_fit_distributed, 3, X, [slice(0, 300), slice(300, 600), slice(0, 0)], algorithm)
+    assert np.all(np.isfinite(empty.means))
+    assert np.allclose(empty.means, full.means)
+    assert np.isclose(empty.sigma_sq, full.sigma_sq)
+
+
+def _coreset_fit_distributed(comm, X, size):
+    np.random.seed(comm.rank)
+    coreset = Coreset('birch')
+    coreset.load_data(X, np.zeros(X.shape[0], dtype=int))
+    coreset.construct(size, comm=comm)
+    gmm = GMM({'algorithm': 'var-GMM-S', 'C': 2, 'Cprime': 2, 'G': 2, 'Niter': 3, 'Ninit': 0,
+               'VERBOSE': dict(VERBOSE)}, comm)
+    gmm.fit_weight(coreset.coreset, coreset.coreset_label, weight=coreset.weight, distributed=True)
+    return gmm, comm.allgather(coreset.coreset.shape)
+
+
+def test_coreset_with_empty_process():
+    X = _data(600)
+    # fewer samples than processes, at least one process draws none
+    gmm, shapes = run_pool(_coreset_fit_distributed, 4, X, 3)
+    assert sum(shape[0] for shape in shapes) == 3
+    assert min(shape[0] for shape in shapes) == 0
+    assert all(shape[1:] == (2,) for shape in shapes)
+    assert np.all(np.isfinite(gmm.means))
+    assert np.isfinite(gmm.sigma_sq)
+
+
+def test_coreset_with_process_without_rows():
+    X = _data(600)
+    # 3 rows on 4 processes, one process has no rows to sample from
+    gmm, shapes = run_pool(_coreset_fit_distributed, 4, X[:3], 3)
+    assert sum(shape[0] for shape in shapes) == 3
+    assert np.all(np.isfinite(gmm.means))
@@ -0,0 +1,33 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('kmc2')
+pytest.importorskip('numba')
+
+from truncated_GMM import TruncatedGaussianMixture as GMM
+
+BIRCH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dataset', 'birch1.txt')
+VERBOSE = {'ll': True, 'fe': True, 'qe': True, 'cs': True, 'nd': True, 'np': np.inf}
+
+
+def _fit(X, backend, algorithm, prune):
+    np.random.seed(0)
+    gmm = GMM({'algorithm': algorithm, 'C': 50, 'Cprime': 3, 'G': 5, 'Niter': 10, 'Ninit': 0,
+               'backend': backend, 'dtype': 'float32', 'prune': prune, 'VERBOSE': dict(VERBOSE)})
+    gmm.fit(X, np.zeros(X.shape[0], dtype=int))
+    return gmm
+
+
+@pytest.mark.parametrize('algorithm,prune', [('var-GMM-S', False), ('var-GMM-X', False), ('var-GMM-X', True)])
+def test_backends_agree_float32(algorithm, prune):
+    X = np.loadtxt(BIRCH, max_rows=5000) / 10000.
+    numpy_gmm = _fit(X, 'numpy', algorithm, prune)
+    numba_gmm = _fit(X, 'numba', algorithm, prune)
+    assert np.array_equal(numpy_gmm.K, numba_gmm.K)
+    if algorithm == 'var-GMM-S':
+        assert np.array_equal(numpy_gmm.G_c, numba_gmm.G_c)
+    assert np.array_equal(numpy_gmm.ndistevals, numba_gmm.ndistevals)
+    # the sufficient statistics are summed in a different order
+    assert np.allclose(numpy_gmm.means, numba_gmm.means, rtol=1e-4)
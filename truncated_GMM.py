@@ -8,15 +8,19 @@ from builtins import range
 warnings.filterwarnings("ignore", category=FutureWarning)
 
 import numpy as np
-from mpi4py import MPI
-from scipy.stats import multivariate_normal
 from scipy.stats import mode as statsmode
 from sklearn import metrics
+from sklearn.neighbors import BallTree, KDTree
 
 import kmc2
 
+import utils.kernels as kernels
+from utils.comm import get_comm
+from utils.data import iter_chunks
+
 import matplotlib.pyplot as plt
 import pylab
+from concurrent.futures import ThreadPoolExecutor
 from timeit import default_timer as timer
 
 
@@ -33,7 +37,7 @@ class TruncatedGaussianMixture(object):
     GMMs).
     """
 
-    def __init__(self, params={}, comm=MPI.COMM_WORLD):
+    def __init__(self, params={}, comm=None):
         """ Initialize class variables """
 
         # ===== Set Model Parameters =============
@@ -45,6 +49,25 @@ class TruncatedGaussianMixture(object):
             'Niter': 25,
             'Ninit': 0,
             'init_values': None,
+            'chunk_size': None,
+            'max_block_bytes': 2 ** 27,
+            'backend': 'numpy',
+            'n_threads': 1,
+            'dtype': 'float64',
+            'prune': False,
+            'neighbor_index': 'kd_tree',
+            'init_K': 'random',
+            'n_projections': 4,
+            'neighbor_tol': None,
+            'tol_fe': None,
+            'tol_K': None,
+            'tol_drift': None,
+            'batch_size': 10000,
+            'step_tau': 1.,
+            'step_kappa': 0.7,
+            'stream_rows': 2 ** 18,
+            'init_samples': 100000,
+            'rebalance_tol': None,
             'VERBOSE': {'ll': False,
                         'fe': False,
                         'qe': False,
@@ -56,8 +79,31 @@ class TruncatedGaussianMixture(object):
         self.params.update(params)
 
         self.n_iteration = 0
-        self.comm = comm
+        self.comm = get_comm(comm)
+        # (n_samples, rows of this process), see _my_rows
+        self._rows = None
+        self.kernels = kernels.get_backend(self.params['backend'])
+        # storage type of the data, the means and the log-joints,
+        # sufficient statistics are always accumulated in float64
+        self.dtype = np.dtype(self.params['dtype'])
+        assert self.dtype in [np.float32, np.float64], "dtype must be 'float32' or 'float64'"
+        if self.params['prune'] and self.params['algorithm'][:9] == 'var-GMM-S':
+            warnings.warn("prune is only used by 'var-GMM-X', the neighbors of 'var-GMM-S' are "
+                          "estimated from the log-joints of all candidates.")
         self.ndistevals = np.zeros((self.params['Niter']), dtype='int32')
+        # process local compute time of the last E-step, and of the
+        # E-steps of all processes per iteration (fit and fit_weight)
+        self.e_step_time = 0.
+        self.e_step_times = np.zeros((self.params['Niter'], self.comm.size))
+        # bytes sent and time spent in collectives by this process per
+        # EM iteration (E- and M-step)
+        self.comm_bytes = np.zeros((self.params['Niter']), dtype=np.int64)
+        self.comm_time = np.zeros((self.params['Niter']))
+        # why the last fit stopped and after how many iterations
+        self.stop_reason, self.n_iterations = None, 0
+        # var-GMM-S: number of rows of G_c refreshed and reused per iteration
+        self.G_c_refreshed = np.zeros((self.params['Niter']), dtype='int32')
+        self.G_c_reused = np.zeros((self.params['Niter']), dtype='int32')
 
         # the model parameters will be initialized when fitting the
         # model to data, as the initilializing process takes the given
@@ -66,6 +112,9 @@ class TruncatedGaussianMixture(object):
         self.sigma_sq = None
         self.K = None
         self.labels = None
+        # squared norms of the (local) data points and of the means,
+        # stored together with the array they belong to
+        self._norm_cache = {'X': (None, None), 'means': (None, None)}
         self.colors = {
             'aliceblue': '#F0F8FF',
             'antiquewhite': '#FAEBD7',
@@ -230,7 +279,30 @@ class TruncatedGaussianMixture(object):
             The path/folder/file to save your outputs.
         """
         print("Start Fitting")
+        self._fit(X, y_true, filename)
+        print("End of fitting")
+
+    def _fit(self, X, y_true=None, filename=None, weight=None, distributed=False):
+        """ EM iterations of fit and fit_weight
+
+        Parameters
+        ----------
+        X : array-like, shape (n_samples, n_features)
+            The data to fit the model to.
+
+        y_true : array-like, shape (n_samples, )
+            The class labels to calculate the clustering scores.
 
+        filename : string
+            The path/folder/file to save your outputs.
+
+        weight : array-like, shape (n_samples, )
+            Weights of the data points (default: None, unit weights).
+
+        distributed : boolean
+            If True, X, y_true and weight are the data points of this
+            process (see fit_weight).
+        """
         comm = self.comm
         rank = comm.rank
         size = comm.size
@@ -238,41 +310,42 @@ class TruncatedGaussianMixture(object):
         record = {"scores": np.zeros((0, 8)), "training time": 0}
 
         # ===== Initialization ===================
+        if distributed:
+            assert self.params['rebalance_tol'] is None, "rebalance_tol needs the data of all processes"
+            # the scores are computed from the labels of all processes
+            y_true = comm.allgatherv(np.asarray(y_true)) if y_true is not None else None
         # initialize model parameters
-        self._initialize(X)
+        self._initialize(comm.allgatherv(np.asarray(X, dtype=self.dtype)) if distributed else X)
         theta = {'means': self.means,
                  'sigma_sq': self.sigma_sq}
 
-        # allocate data points to threads
-        my_n = [i for i in range(X.shape[0]) if i * size // X.shape[0] == rank]
-        my_X = X[my_n]
+        # allocate data points to threads (a view of the rows of this
+        # process, only these rows are read from HDF5 files or memory maps)
+        my_rows = slice(None) if distributed else self._my_rows(X.shape[0])
+        my_X = np.asarray(X[my_rows], dtype=self.dtype)
         print('rank {} data shape: {}'.format(rank, my_X.shape))
+        self._sq_norms(my_X, 'X')
+        if weight is not None:
+            weight = np.asarray(weight, dtype=np.float64)
+            assert weight.shape == (X.shape[0],), "weight must have shape (n_samples, )"
+            my_weight = weight[my_rows]
+        else:
+            my_weight = None
 
         my_N, D = my_X.shape
-        N = np.empty((1), dtype='int32')
-        comm.Allreduce(np.asarray(my_N, dtype='int32'), N, op=MPI.SUM)
-        N = N[0]
+        N = comm.allreduce(np.asarray(my_N, dtype='int32'))
 
         C, Cprime, G = self.params['C'], self.params['Cprime'], self.params['G']
         Niter, Ninit = self.params['Niter'], self.params['Ninit']
         algorithm = self.params['algorithm']
         VERBOSE = self.params['VERBOSE']
 
-        # initialize K randomly
-        self.K = np.asarray([np.random.choice(C, Cprime) for _ in range(my_N)]).astype(np.int32)
+        # initialize K (C' distinct clusters per data point)
+        self.K = self._initial_K(my_X, Cprime)
+        self._reset_bounds(my_N)
 
         # G_c contains the Cluster data in G_c[c]
-        # initialize G_c randomly, but making sure that c is in G_c
-        if algorithm[:9] == 'var-GMM-S':
-            self.G_c = np.asarray([
-                np.concatenate(
-                    [np.asarray([c]),
-                     np.random.permutation(
-                         np.delete(np.arange(C), np.asarray([c])))
-                     ], axis=0)[:G]
-                for c in range(C)])
-        else:
-            self.G_c = None
+        self.G_c = self._initial_G_c(C, G)
 
         # iterate Ninit times to gain better K and G_c
         if Cprime < C:
@@ -288,8 +361,7 @@ class TruncatedGaussianMixture(object):
             purity_score, NMI_score, AMI_score = self.clustering_scores(my_X, y_true, theta['means'],
                                                                         distributed=True) if VERBOSE['cs'] else (
                 None, None, None)
-            ndistevals = np.empty((1), dtype='int32')
-            comm.Allreduce(self.ndistevals[self.n_iteration - 1], ndistevals, op=MPI.SUM)
+            ndistevals = comm.allreduce(self.ndistevals[self.n_iteration - 1:self.n_iteration])
             if rank == 0:
                 strn = ('{:' + str(int(np.log10(Niter) + 1)) + '}').format(self.n_iteration)
                 strfe = '\t{:13.6f}'.format(free_energy) if VERBOSE['fe'] else '\t{:13}'.format('--')
@@ -362,14 +434,18 @@ class TruncatedGaussianMixture(object):
         self.training_time = 0.
         training_times = []
         indicies = []
+        self.stop_reason, prev_free_energy = 'Niter reached', None
         for self.n_iteration in range(1, Niter + 1):
             print("iteration {} times".format(self.n_iteration))
             self.start_time = timer()
+            comm_start = (comm.bytes_sent, comm.time)
             # --- E-step ---
-            stats, theta['K'], G_c = self._e_step(my_X, algorithm, Cprime, G, countevals=VERBOSE['nd'])
+            stats, theta['K'], G_c = self._e_step(my_X, algorithm, Cprime, G, countevals=VERBOSE['nd'],
+                                                  reduce_stats=True, weight=my_weight)
             # print("log_joint_xc:", stats['log_joint_xc'])
             # --- M-step ---
             theta = self._m_step(my_X, stats, theta)
+            self._record_comm(comm_start)
             training_times.append(timer() - self.start_time)
             self.training_time += timer() - self.start_time
             # --- output ---
@@ -379,19 +455,10 @@ class TruncatedGaussianMixture(object):
             q_error = self.quantization_error(my_X, theta['means'], distributed=True)
             purity_score, NMI_score, AMI_score = self.clustering_scores(my_X, y_true, theta['means'],
                                                                         distributed=True)
-            ndistevals = np.empty((1), dtype='int32')
-            comm.Allreduce(self.ndistevals[self.n_iteration - 1], ndistevals, op=MPI.SUM)
-            strn = ('{:' + str(int(np.log10(Niter) + 1)) + '}').format(self.n_iteration)
-            strfe = '\t{:13.6f}'.format(free_energy)
-            strll = '\t{:13.6f}'.format(loglikelihood)
-            strqe = '\t{:13.6f}'.format(q_error)
-            strpur = '\t{:8.6f}'.format(purity_score)
-            strnmi = '\t{:8.6f}'.format(NMI_score)
-            strami = '\t{:8.6f}'.format(AMI_score)
-            strnd = '\t{}/{} (x{:.2f})'.format(ndistevals[0], N * C, N * C / ndistevals[0]) if VERBOSE[
-                                                                                                   'nd'] and self.n_iteration > 0 else '\t{:8}'.format(
-                '--')
-            indicies.append([strn, strfe, strll, strqe, strpur, strnmi, strami, strnd])
+            indicies.append(self._iteration_strings(N, free_energy, loglikelihood, q_error,
+                                                    (purity_score, NMI_score, AMI_score)))
+            stop_reason = self._stop_reason(free_energy, prev_free_energy, self.K, theta['K'], N)
+            prev_free_energy = free_energy
 
             # if self.n_iteration == Niter:
             #     VERBOSE['fe'], VERBOSE['ll'], VERBOSE['qe'], VERBOSE['cs'] = (True, True, True, True)
@@ -405,6 +472,16 @@ class TruncatedGaussianMixture(object):
             # --- set parameters ---
             self.means, self.sigma_sq, self.K, self.G_c, self.log = theta['means'], theta['sigma_sq'], theta['K'], G_c, \
                                                                     stats['log_joint_xc']
+            # --- balance the E-step time between processes ---
+            # (rows are only moved if another iteration follows)
+            last = stop_reason is not None or self.n_iteration == Niter
+            my_X = self._rebalance(X, my_X, migrate=not last)
+            if weight is not None and not distributed:
+                my_weight = weight[self._my_rows(X.shape[0])]
+            if stop_reason is not None:
+                self.stop_reason = stop_reason
+                break
+        self.n_iterations = self.n_iteration
 
         # determine labels by training result
         self.determine_labels()
@@ -452,8 +529,6 @@ class TruncatedGaussianMixture(object):
             #             file.write("iteration:{}--free_energy:{}--loglikelihood:{}--q-error:{}--purity_score:{}--NMI_score:{}--AMI_score:{}--ndistevals:{} "
             #                        .format(index[0], index[1], index[2], index[3], index[4], index[5], index[6], index[7]))
 
-        print("End of fitting")
-
     def write_indices(self, filename, training_times, indicies):
         print('Pure training time: {:.2f}s'.format(self.training_time))
         if filename is not None:
@@ -467,24 +542,33 @@ class TruncatedGaussianMixture(object):
                     file.write(
                         "iteration:{}--free_energy:{}--loglikelihood:{}--q-error:{}--purity_score:{}--NMI_score:{}--AMI_score:{}--ndistevals:{}\n"
                             .format(index[0], index[1], index[2], index[3], index[4], index[5], index[6], index[7]))
+                if self.params['algorithm'] == 'var-GMM-S' and self.params['neighbor_tol'] is not None:
+                    file.write("G_c rows refreshed/reused per iteration : {}\n".format(
+                        ' '.join('{}/{}'.format(r, u) for r, u in zip(self.G_c_refreshed, self.G_c_reused))))
+                file.write("Stopped after {} iterations : {}\n".format(self.n_iterations, self.stop_reason))
+                if self.comm.size > 1:
+                    file.write("Collectives per iteration, bytes sent/time of process 0 : {}\n".format(' '.join(
+                        '{}/{:.4f}s'.format(b, t) for b, t in zip(self.comm_bytes[:self.n_iterations],
+                                                                  self.comm_time[:self.n_iterations]))))
+                    file.write("E-step time per iteration, max/mean over processes : {}\n".format(' '.join(
+                        '{:.3f}/{:.3f}'.format(np.max(t), np.mean(t)) for t in self.e_step_times[:self.n_iterations])))
 
     def determine_labels(self):
-        self.labels = np.zeros(self.log.shape[0], dtype=np.int)
+        """Label each data point with the cluster in K(n) of highest log-joint"""
         print("log shape : ", self.log.shape)
-        for i in range(self.log.shape[0]):
-            logs = self.log[i]
-            max = -np.inf
-            idx = 0
-            for j in range(logs.size):
-                if logs[j] > max:
-                    max = logs[j]
-                    idx = j
-            self.labels[i] = int(idx)
+        self.labels = self.K[np.arange(self.K.shape[0]), np.argmax(self.log, axis=1)]
         print("labels:", self.labels)
 
     # add origin_X to draw
-    def fit_weight(self, X, y_true=None, filename=None, origin_X=None, plot=False, weight=None):
-        """ Fit model to data.
+    def fit_weight(self, X, y_true=None, filename=None, origin_X=None, plot=False, weight=None,
+                   distributed=False):
+        """ Fit model to weighted data, e.g. a coreset (see utils.coreset).
+
+        Each data point contributes its weight times its posterior to
+        the sufficient statistics of the M-step, and sigma_sq is
+        normalized by the summed weights instead of the number of data
+        points. With the importance weights of a coreset the weighted
+        statistics are unbiased estimates of those of the full data.
 
         Parameters
         ----------
@@ -497,115 +581,23 @@ class TruncatedGaussianMixture(object):
 
         filename : string
             The path/folder/file to save your outputs.
-        """
-        print("Strat fitting with weight")
-
-        comm = self.comm
-        rank = comm.rank
-        size = comm.size
-
-        record = {"scores": np.zeros((0, 8)), "training time": 0}
-
-        # ===== Initialization ===================
-        # initialize model parameters
-        self._initialize(X)
-        theta = {'means': self.means,
-                 'sigma_sq': self.sigma_sq}
-
-        # allocate data points to threads
-        my_n = [i for i in range(X.shape[0]) if i * size // X.shape[0] == rank]
-        my_X = X[my_n]
-        print('rank {} data shape: {}'.format(rank, my_X.shape))
-
-        my_N, D = my_X.shape
-        N = np.empty((1), dtype='int32')
-        comm.Allreduce(np.asarray(my_N, dtype='int32'), N, op=MPI.SUM)
-        N = N[0]
-
-        C, Cprime, G = self.params['C'], self.params['Cprime'], self.params['G']
-        Niter, Ninit = self.params['Niter'], self.params['Ninit']
-        algorithm = self.params['algorithm']
-        VERBOSE = self.params['VERBOSE']
 
-        # initialize K randomly
-        self.K = np.asarray([np.random.choice(C, Cprime) for _ in range(my_N)]).astype(np.int32)
+        weight : array-like, shape (n_samples, )
+            Weights of the data points (default: None, unit weights as
+            in fit).
 
-        # G_c contains the Cluster data in G_c[c]
-        # initialize G_c randomly, but making sure that c is in G_c
-        if algorithm[:9] == 'var-GMM-S':
-            self.G_c = np.asarray([
-                np.concatenate(
-                    [np.asarray([c]),
-                     np.random.permutation(
-                         np.delete(np.arange(C), np.asarray([c])))
-                     ], axis=0)[:G]
-                for c in range(C)])
-        else:
-            self.G_c = None
-
-        # iterate Ninit times to gain better K and G_c
-        if Cprime < C:
-            for _ in range(Ninit):
-                self.stat, self.K, self.G_c = self._e_step(my_X, algorithm, Cprime)
-                self.log = self.stat['log_joint_xc']
-
-        # ===== Learning iterations ==============
-        self.training_time = 0.
-        training_times = []
-        indicies = []
-        for self.n_iteration in range(1, Niter + 1):
-            print("iteration {} times".format(self.n_iteration))
-            self.start_time = timer()
-            # --- E-step ---
-            stats, theta['K'], G_c = self._e_step(my_X, algorithm, Cprime, G, countevals=VERBOSE['nd'])
-            # print("log_joint_xc:", stats['log_joint_xc'])
-            # --- M-step ---
-            theta = self._m_step_weight(my_X, stats, theta, weight)
-
-            training_times.append(timer() - self.start_time)
-            self.training_time += timer() - self.start_time
-            # --- output ---
-            if self.n_iteration == Niter:
-                VERBOSE['fe'], VERBOSE['ll'], VERBOSE['qe'], VERBOSE['cs'] = (True, True, True, True)
-
-            # use other output
-            # if (VERBOSE['fe'] or VERBOSE['ll'] or VERBOSE['qe'] or VERBOSE['cs'] or VERBOSE['nd']) and (y_true is not None):
-            #     verbose_output(my_X, y_true, theta, stats['posterior'], filename)
-
-            free_energy = self.free_energy(my_X, theta, stats['posterior'], distributed=True)
-            loglikelihood = self.loglikelihood(my_X, theta, distributed=True)
-            q_error = self.quantization_error(my_X, theta['means'], distributed=True)
-            purity_score, NMI_score, AMI_score = self.clustering_scores(my_X, y_true, theta['means'],
-                                                                        distributed=True)
-            ndistevals = np.empty((1), dtype='int32')
-            comm.Allreduce(self.ndistevals[self.n_iteration - 1], ndistevals, op=MPI.SUM)
-            strn = ('{:' + str(int(np.log10(Niter) + 1)) + '}').format(self.n_iteration)
-            strfe = '\t{:13.6f}'.format(free_energy)
-            strll = '\t{:13.6f}'.format(loglikelihood)
-            strqe = '\t{:13.6f}'.format(q_error)
-            strpur = '\t{:8.6f}'.format(purity_score)
-            strnmi = '\t{:8.6f}'.format(NMI_score)
-            strami = '\t{:8.6f}'.format(AMI_score)
-            strnd = '\t{}/{} (x{:.2f})'.format(ndistevals[0], N * C, N * C / ndistevals[0]) if (VERBOSE['nd'] and self.n_iteration > 0) else '\t{:8}'.format('--')
-            indicies.append([strn, strfe, strll, strqe, strpur, strnmi, strami, strnd])
-
-            # --- set parameters ---
-            self.means, self.sigma_sq, self.K, self.G_c, self.log = theta['means'], theta['sigma_sq'], theta['K'], G_c, \
-                                                                    stats['log_joint_xc']
-
-        self.determine_labels()
+        distributed : boolean (default: False)
+            Denote if the data is already distributed between processes,
+            e.g. a coreset built with Coreset.construct(comm=...). X,
+            y_true and weight are then the data points of this process;
+            only the (small) coreset is gathered to initialize the means.
+            If not it is assumed, that each process holds the same data.
+        """
+        print("Strat fitting with weight")
+        self._fit(X, y_true, filename, weight=weight, distributed=distributed)
         print("{} With Weight Training Complete".format(filename))
 
-        if rank == 0:
-            self.write_indices(filename, training_times, indicies)
-            print('Pure training time: {:.2f}s'.format(self.training_time))
-
-            # if filename is not None:
-            #     with open(''.join((filename, '_results.txt')), 'w') as file:
-            #         for i in range(len(training_times)):
-            #             file.write("Iteration {} : {:.2f}s\n".format(i, training_times[i]))
-            #         file.write("Pure training time : {:.2f}s".format(self.training_time))
-
+        if self.comm.rank == 0:
             if plot == True:
                 # only show the cluster information G_c[c] here when dimension=2
                 if origin_X.shape[1] == 2:
@@ -626,7 +618,7 @@ class TruncatedGaussianMixture(object):
                         ax.set_facecolor('gainsboro')
                     except:
                         ax.set_axis_bgcolor('gainsboro')
-                    plt.scatter(theta['means'][:, 0], theta['means'][:, 1],
+                    plt.scatter(self.means[:, 0], self.means[:, 1],
                                 s=60, marker='x', color='#CC0000', zorder=5)
                     pylab.savefig(
                         filename + "_all" + pylab.datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + '.png')
@@ -675,6 +667,292 @@ class TruncatedGaussianMixture(object):
 
         print("End of fitting")
 
+    def fit_minibatch(self, X, y_true=None, filename=None):
+        """ Fit model to data with stochastic mini-batch variational EM.
+
+        In each of the Niter steps every process runs the truncated
+        E-step on a mini-batch of its own data points (params['batch_size']
+        data points over all processes, drawn without replacement within
+        an epoch). Only the sufficient statistics of the batches are
+        reduced; they are blended into running statistics with the step
+        size rho_t = (step_tau + t) ** -step_kappa, and the means and
+        sigma_sq are derived from the running statistics. K(n) of the
+        data points and G_c persist between steps. The distance bounds of
+        params['prune'] are not used, as they are only valid between
+        consecutive E-steps of the same data points.
+
+        Parameters
+        ----------
+        X : array-like, shape (n_samples, n_features)
+            The data to fit the model to.
+
+        y_true : array-like, shape (n_samples, )
+            The class labels to calculate the clustering scores after
+            training (not used for fitting of the model itself)
+
+        filename : string
+            The path/folder/file to save your outputs.
+        """
+        print("Start fitting with mini-batches")
+
+        comm = self.comm
+        rank = comm.rank
+        size = comm.size
+
+        # ===== Initialization ===================
+        # initialize model parameters
+        self._initialize(X)
+        theta = {'means': self.means,
+                 'sigma_sq': self.sigma_sq}
+
+        # allocate data points to threads (a view of the rows of this
+        # process, only these rows are read from HDF5 files or memory maps)
+        my_X = np.asarray(X[self._my_rows(X.shape[0])], dtype=self.dtype)
+        print('rank {} data shape: {}'.format(rank, my_X.shape))
+
+        my_N, D = my_X.shape
+        N = comm.allreduce(np.asarray(my_N, dtype='int32'))
+
+        C, Cprime, G = self.params['C'], self.params['Cprime'], self.params['G']
+        Niter = self.params['Niter']
+        algorithm = self.params['algorithm']
+        VERBOSE = self.params['VERBOSE']
+        tau, kappa = self.params['step_tau'], self.params['step_kappa']
+        assert tau >= 1. and 0.5 < kappa <= 1., "step size requires step_tau >= 1 and 0.5 < step_kappa <= 1"
+
+        # process local batch size, proportional to the local data points
+        my_B = min(my_N, max(1, int(self.params['batch_size']) * my_N // N))
+        B = comm.allreduce(np.asarray(my_B, dtype='int64'))
+
+        # initialize K (C' distinct clusters per data point)
+        K = self._initial_K(my_X, Cprime)
+
+        # G_c contains the Cluster data in G_c[c]
+        self.G_c = self._initial_G_c(C, G)
+
+        # running sufficient statistics, scaled to N data points
+        running = {'sum_resp': np.zeros((C), dtype=np.float64),
+                   'sum_x': np.zeros((C, D), dtype=np.float64),
+                   'sum_x2': np.zeros((C), dtype=np.float64)}
+
+        # ===== Learning iterations ==============
+        self.training_time = 0.
+        training_times = []
+        indicies = []
+        order, position = np.random.permutation(my_N), 0
+        for self.n_iteration in range(1, Niter + 1):
+            print("step {}".format(self.n_iteration))
+            self.start_time = timer()
+            # --- draw the batch (a new permutation per epoch) ---
+            if position + my_B > my_N:
+                order, position = np.random.permutation(my_N), 0
+            batch = np.sort(order[position:position + my_B])
+            position += my_B
+            batch_X = my_X[batch]
+            # --- E-step on the batch, with the stored K(n) ---
+            self.K = K[batch]
+            self._reset_bounds(my_B)
+            stats, theta['K'], G_c = self._e_step(batch_X, algorithm, Cprime, G, countevals=VERBOSE['nd'],
+                                                  prune=False)
+            K[batch] = theta['K']
+            # --- M-step from the running statistics ---
+            rho = (tau + self.n_iteration - 1) ** -kappa
+            for key in running:
+                running[key] *= 1. - rho
+                running[key] += rho * float(N) / float(B) * comm.allreduce(stats[key])
+            sum_resp = running['sum_resp']
+            # clusters without responsibility keep their means
+            means = np.array(theta['means'], dtype=np.float64)
+            means[sum_resp != 0] = running['sum_x'][sum_resp != 0] / sum_resp[sum_resp != 0, np.newaxis]
+            self.drift = np.sqrt(np.sum(np.square(means - theta['means']), axis=1))
+            Mu2 = self._sq_norms(means, 'means')
+            theta['sigma_sq'] = np.sum(running['sum_x2'] - Mu2 * sum_resp) / float(N * D)
+            theta['means'] = means.astype(self.dtype, copy=False)
+            training_times.append(timer() - self.start_time)
+            self.training_time += timer() - self.start_time
+            # --- output (on the batch) ---
+            indicies.append(self._iteration_strings(
+                B,
+                self.free_energy(batch_X, theta, stats['posterior'], distributed=True) if VERBOSE['fe'] else None,
+                self.loglikelihood(batch_X, theta, distributed=True) if VERBOSE['ll'] else None,
+                self.quantization_error(batch_X, theta['means'], distributed=True) if VERBOSE['qe'] else None))
+
+            # --- set parameters ---
+            self.means, self.sigma_sq, self.G_c = theta['means'], theta['sigma_sq'], G_c
+        self.stop_reason, self.n_iterations = 'Niter reached', self.n_iteration
+
+        # a final E-step over all local data points (not counted) gives
+        # the posteriors and labels of the points never or not recently
+        # drawn
+        self.K = K
+        self._reset_bounds(my_N)
+        self.stat, self.K, _ = self._e_step(my_X, algorithm, Cprime, G, prune=False)
+        self.log = self.stat['log_joint_xc']
+        self.determine_labels()
+
+        if y_true is not None and VERBOSE['cs']:
+            purity_score, NMI_score, AMI_score = self.clustering_scores(my_X, y_true, self.means, distributed=True)
+            indicies[-1][4:7] = ['\t{:8.6f}'.format(purity_score), '\t{:8.6f}'.format(NMI_score),
+                                 '\t{:8.6f}'.format(AMI_score)]
+
+        if rank == 0:
+            self.write_indices(filename, training_times, indicies)
+
+        print("End of fitting")
+
+    def fit_stream(self, X, y_true=None, filename=None):
+        """ Fit model to data that is read chunk by chunk, e.g. from an
+        h5py Dataset that does not fit into memory.
+
+        Each process streams over its contiguous part of the rows in
+        chunks of about params['stream_rows'] rows (the next chunk is
+        prefetched on a background thread). Per chunk the truncated
+        E-step is run and the sufficient statistics are accumulated, the
+        M-step follows after each pass. Only K(n) and the labels are
+        kept for all data points. G_c is fixed during a pass, var-GMM-S
+        updates it from the statistics of all chunks. The means are
+        initialized with kmc2 on
+        params['init_samples'] evenly strided rows. The distance bounds
+        of params['prune'] are not used.
+
+        Parameters
+        ----------
+        X : array-like, shape (n_samples, n_features)
+            The data to fit the model to, all processes pass the whole
+            (lazy) data set.
+
+        y_true : array-like, shape (n_samples, )
+            The class labels to calculate the clustering scores after
+            training (not used for fitting of the model itself)
+
+        filename : string
+            The path/folder/file to save your outputs.
+        """
+        print("Start fitting from chunks")
+
+        comm = self.comm
+        rank = comm.rank
+        size = comm.size
+
+        # ===== Initialization ===================
+        # initialize model parameters on an evenly strided subsample
+        n_samples, D = X.shape
+        stride = max(1, n_samples // int(self.params['init_samples']))
+        self._initialize(np.asarray(X[np.random.randint(stride)::stride] if rank == 0 else X[:0],
+                                    dtype=np.float64))
+        theta = {'means': self.means,
+                 'sigma_sq': self.sigma_sq}
+
+        # contiguous rows per process (the E-steps of the chunks do not
+        # communicate, so the number of chunks may differ between processes)
+        my_rows = self._my_rows(n_samples)
+        start, stop = my_rows.start, my_rows.stop
+        my_N = stop - start
+        N = comm.allreduce(np.asarray(my_N, dtype='int32'))
+        rows = int(self.params['stream_rows'])
+        chunks = getattr(X, 'chunks', None)
+        if chunks is not None:
+            # align the chunks to the storage chunks of the data set
+            rows = max(chunks[0], rows // chunks[0] * chunks[0])
+        n_chunks = -(-my_N // rows)
+        print('rank {} data rows: {}-{} in {} chunks'.format(rank, start, stop, n_chunks))
+
+        C, Cprime, G = self.params['C'], self.params['Cprime'], self.params['G']
+        Niter, Ninit = self.params['Niter'], self.params['Ninit']
+        algorithm = self.params['algorithm']
+        VERBOSE = self.params['VERBOSE']
+
+        # K(n) is initialized while the first pass reads the chunks
+        K = np.empty((my_N, Cprime), dtype=np.int32)
+        self.labels = np.empty((my_N), dtype=np.int32)
+
+        # G_c contains the Cluster data in G_c[c]
+        self.G_c = self._initial_G_c(C, G)
+
+        def stream_e_step(countevals, first_pass):
+            """ one pass of E-steps over the chunks, returns the summed
+            sufficient statistics and the summed log-joints of K(n) """
+            totals = {'sum_resp': np.zeros((C), dtype=np.float64),
+                      'sum_x': np.zeros((C, D), dtype=np.float64),
+                      'sum_x2': np.zeros((C), dtype=np.float64)}
+            my_log_evidence = 0.
+            # the neighbors are fixed during a pass, for var-GMM-S they are
+            # updated from the neighbor statistics of all chunks afterwards
+            G_c = self._nearest_means(G, countevals=countevals) if algorithm[:9] == 'var-GMM-X' else self.G_c
+            neighbor_keys = np.zeros((0), dtype=np.int64)
+            neighbor_stats = np.zeros((0, 2), dtype=np.float64)
+            touched = np.zeros((C), dtype=bool)
+            for chunk, X_chunk in iter_chunks(X, start, stop, n_chunks, dtype=self.dtype):
+                if first_pass:
+                    K[chunk] = self._initial_K(X_chunk, Cprime)
+                self.K = K[chunk]
+                stats, K[chunk], _ = self._e_step(X_chunk, algorithm, Cprime, G, countevals=countevals,
+                                                  prune=False, G_c=G_c)
+                for key in totals:
+                    totals[key] += stats[key]
+                if algorithm[:9] == 'var-GMM-S':
+                    neighbor_keys, neighbor_stats = _reduce_by_key(
+                        np.concatenate([neighbor_keys, stats['neighbor_keys']]),
+                        np.concatenate([neighbor_stats, stats['neighbor_stats']]))
+                    touched |= stats['touched']
+                log_joint_xc = stats['log_joint_xc'].astype(np.float64)
+                shift = np.max(log_joint_xc, axis=1, keepdims=True)
+                my_log_evidence += np.sum(np.log(np.sum(np.exp(log_joint_xc - shift), axis=1)) + shift[:, 0])
+                self.labels[chunk] = K[chunk][np.arange(K[chunk].shape[0]), np.argmax(log_joint_xc, axis=1)]
+            if algorithm[:9] == 'var-GMM-S':
+                self.G_c = self._update_neighbors(neighbor_keys, neighbor_stats, touched, G_c, countevals)
+            return totals, my_log_evidence
+
+        # iterate Ninit times to gain better K and G_c
+        Ninit = Ninit if Cprime < C else 0
+        for n_pass in range(Ninit):
+            stream_e_step(countevals=False, first_pass=n_pass == 0)
+
+        # ===== Learning iterations ==============
+        self.training_time = 0.
+        training_times = []
+        indicies = []
+        for self.n_iteration in range(1, Niter + 1):
+            print("iteration {} times".format(self.n_iteration))
+            self.start_time = timer()
+            # --- E-step ---
+            stats, my_log_evidence = stream_e_step(VERBOSE['nd'], first_pass=self.n_iteration == 1 and Ninit == 0)
+            # free energy of the new K(n) with the previous parameters
+            log_evidence = comm.allreduce(np.asarray(my_log_evidence, dtype='float64'))
+            free_energy = -np.log(C) - D / 2. * np.log(2. * np.pi * self.sigma_sq) + log_evidence / float(N)
+            # --- M-step ---
+            sum_resp = comm.allreduce(stats['sum_resp'])
+            means = comm.allreduce(stats['sum_x'])
+            means[sum_resp != 0] /= sum_resp[sum_resp != 0, np.newaxis]
+            self.drift = np.sqrt(np.sum(np.square(means - theta['means']), axis=1))
+            Mu2 = self._sq_norms(means, 'means')
+            theta['sigma_sq'] = np.sum(comm.allreduce(stats['sum_x2']) - Mu2 * sum_resp) / float(N * D)
+            theta['means'] = means.astype(self.dtype, copy=False)
+            training_times.append(timer() - self.start_time)
+            self.training_time += timer() - self.start_time
+            # --- output ---
+            indicies.append(self._iteration_strings(N, free_energy))
+
+            # --- set parameters ---
+            self.means, self.sigma_sq = theta['means'], theta['sigma_sq']
+        self.stop_reason, self.n_iterations = 'Niter reached', self.n_iteration
+        self.K = K
+
+        if y_true is not None and VERBOSE['cs']:
+            # purity of the labels of the last E-step
+            y_pred = np.concatenate(comm.allgather(self.labels))
+            contingency_matrix = metrics.cluster.contingency_matrix(y_true, y_pred)
+            purity_score = np.sum(np.amax(contingency_matrix, axis=0)) / float(np.sum(contingency_matrix))
+            NMI_score = metrics.normalized_mutual_info_score(y_true, y_pred, average_method='min')
+            AMI_score = metrics.adjusted_mutual_info_score(y_true, y_pred, average_method='min')
+            indicies[-1][4:7] = ['\t{:8.6f}'.format(purity_score), '\t{:8.6f}'.format(NMI_score),
+                                 '\t{:8.6f}'.format(AMI_score)]
+
+        if rank == 0:
+            self.write_indices(filename, training_times, indicies)
+
+        print("End of fitting")
+
     def _initialize(self, X):
         """Initialization of the Gaussian mixture parameters.
 
@@ -691,10 +969,13 @@ class TruncatedGaussianMixture(object):
             n_samples, D = X.shape
             self.means = kmc2.kmc2(X, C, afkmc2=True)
             self.sigma_sq = 1.
-        self.means = comm.bcast(self.means, root=0)
+        self.means = np.asarray(comm.bcast(self.means, root=0), dtype=self.dtype)
         self.sigma_sq = comm.bcast(self.sigma_sq, root=0)
+        # drift ||mu_c^new - mu_c^old|| of the last M-step
+        self.drift = None
 
-    def _e_step(self, X, algorithm=None, Cprime=None, G=None, countevals=False):
+    def _e_step(self, X, algorithm=None, Cprime=None, G=None, countevals=False, prune=None, G_c=None,
+                reduce_stats=False, weight=None):
         """E step.
 
         Parameters
@@ -718,10 +999,37 @@ class TruncatedGaussianMixture(object):
         countevals : booleans
             If True the number of distance evaluations are counted.
 
+        prune : boolean
+            Use the distance bounds of params['prune'] (default:
+            params['prune']). Only used by 'var-GMM-X', as the skipped
+            log-joints would change the neighbors of 'var-GMM-S'.
+
+        G_c : integer array, shape (C components, G components)
+            Fixed neighbors for this E-step (default: None, the neighbors
+            are determined by the algorithm). G_c is then returned
+            unchanged; for 'var-GMM-S' the process local neighbor
+            statistics are added to stats ('neighbor_keys',
+            'neighbor_stats', 'touched') to be passed to
+            _update_neighbors later.
+
+        reduce_stats : boolean
+            If True the reduction of the sufficient statistics between
+            processes is started (stats['reduction'], see _reduce_stats)
+            before the neighbors are updated, so that it overlaps with
+            the update (default: False).
+
+        weight : array-like, shape (n_samples, )
+            Weights of the data points in the sufficient statistics
+            (default: None, unit weights). stats['N'] is then the sum of
+            the weights instead of the number of data points.
+
         Returns
         -------
-        stats : dictionary {'posterior', 'log_joint_xc'}
-            posterior distribution and the log-joint of x and c
+        stats : dictionary {'posterior', 'log_joint_xc', 'K', 'sum_resp', 'sum_x', 'sum_x2', 'N'}
+            posterior distribution and the log-joint of x and c, both
+            stored compactly with shape (N samples, C' components) for
+            the clusters in K(n), and the (process local) sufficient
+            statistics for the M-step
 
         K : integer numpy array, shape (N samples, C' components)
             index set K(n)
@@ -741,204 +1049,393 @@ class TruncatedGaussianMixture(object):
 
         my_N, D = X.shape
         C = self.params['C']
+        X_sq = self._sq_norms(X, 'X')
 
-        stats = {}
-
-        def truncate(p, K, fill=-np.inf):
-            """ Truncate distribution p to index set K
+        def update_K(X, X_sq, K_old, G_c, Cprime, random_c, bounds=None):
+            """ Update variational truncation parameter K(n)
 
             Parameters
             ----------
-            p : array-like, shape (N samples, C components)
-                (probability) distribution to truncate
+            X : array-like, shape (N samples, D features)
+                block of data points
 
-            K : integer array, shape (N samples, C' components)
-                index set of non-zero elements
+            X_sq : array-like, shape (N samples, )
+                squared norms of the data points
 
-            fill: float
-                fill value for values not in K, standard is either -inf
-                for logarithmic distributions or 0 otherwise
+            K_old : integer array, shape (N samples, Cprime components)
+                current index set K(n) of the data points
 
-            Returns
-            -------
-            truncated distribution : numpy array, shape (N samples, C components)
-            """
-            trunc_idx = self._idx_from_K(K)
-            p_trunc = fill * np.ones_like(p, dtype=np.float64)
-            for c in range(C):
-                p_trunc[trunc_idx[c], c] = p[trunc_idx[c], c]
-            return p_trunc
-
-        def update_K(G_c, Cprime, add_random_c=False, countevals=False):
-            """ Update variational truncation parameter K(n)
-
-            Parameters
-            ----------
             G_c : array-like, shape (C components, G components)
                 index set of cluster neighbors
 
             Cprime : integer
                 |K(n)| size of K(n)
 
-            add_random_c : boolean
-                True: add addional random cluster to G_n
+            random_c : integer array, shape (N samples, 0 or 1)
+                addional random cluster added to G_n ('+1' algorithms)
 
-            countevalse : boolean
-                True: count number of evaluations
+            bounds : tuple (lower, valid) or None
+                lower bounds on the distances to the candidates outside
+                of K(n) from the last evaluation of G_n, and whether they
+                still hold for the candidates of G_n (None: no pruning)
 
             Returns
             -------
             K : numpy array, shape (N samples, Cprime components)
                 new index set K(n)
 
-            G_n_log_joint_xc : numpy array, shape (N samples, C components)
-                log-joint of x and c in G_n
+            log_joint_xc : numpy array, shape (N samples, Cprime components)
+                log-joint of x and c for the clusters in K(n)
 
-            """
+            G_n : numpy array, shape (N samples, W candidates)
+                search space G_n, padded with -1
 
+            G_n_log_joint_xc : numpy array, shape (N samples, W candidates)
+                log-joint of x and c in G_n, -inf for the padding and
+                for pruned candidates
+
+            n_evals : integer
+                number of distance evaluations
+
+            bounds : tuple (lower, full) or None
+                updated lower bounds, and which data points were fully
+                evaluated
+            """
             # the union of neighbors of clusters in K(n) defines the
-            # 'search space' G_n for closest clusters
-            if add_random_c:
-                # Append random C into G_c[K_n]
-                # self.K is the candidate set
-                G_n = [np.unique(np.append(np.concatenate(G_c[K_n]), np.random.choice(C))) for K_n in self.K]
+            # 'search space' G_n for closest clusters, stored as a padded
+            # candidate matrix of fixed width W = Cprime * G (+1)
+            G_n = self.kernels.candidates(G_c, K_old, random_c)
+
+            if bounds is None:
+                # calculate log-joints
+                # shape(N,W)
+                # (the distance evaluations are counted by the caller, as
+                # blocks may run in parallel threads)
+                G_n_log_joint_xc = self._log_joint_p_of_x_and_c(X, K=G_n, X_sq=X_sq)
+                n_evals = np.count_nonzero(G_n >= 0)
             else:
-                G_n = [np.unique(np.concatenate(G_c[K_n])) for K_n in self.K]
-
-            # calculate log-joints
-            # shape(N,Cprime)
-            G_n_log_joint_xc = self._log_joint_p_of_x_and_c(X, K=G_n, countevals=countevals)
+                G_n_log_joint_xc, n_evals, bounds = prune_G_n(X, X_sq, K_old, G_n, random_c, *bounds)
 
             # find K to maximize the free energy based on the neighbors
-            # C-Cprime-th will be placed at sorted position, and smaller before it, larger behind it
-            # 0 ... C-Cprime |->larger K[-Cprime] ... K[-1]
             # shape(N,Cprime)
-            K = np.argpartition(G_n_log_joint_xc, C - Cprime, axis=1)[:, -Cprime:]
+            # (G_n always contains K(n), so there are at least Cprime valid candidates)
+            K, log_joint_xc = self.kernels.top_candidates(G_n, G_n_log_joint_xc, Cprime)
+
+            return K, log_joint_xc, G_n, G_n_log_joint_xc, n_evals, bounds
+
+        def prune_G_n(X, X_sq, K_old, G_n, random_c, lower, valid):
+            """ Log-joints of the search space G_n, skipping candidates
+            that provably cannot enter the top-Cprime (Hamerly-style bounds)
+
+            The distances to the clusters in K(n) (and to the random
+            cluster) are evaluated first. If they are all smaller than
+            the lower bound on the distances to the other candidates,
+            K(n) does not change and the other candidates are skipped.
+            Otherwise the remaining candidates are evaluated and the
+            lower bound is reset to the distance of the best candidate
+            outside of K(n).
+            """
+            N, W = G_n.shape
+            sigma_sq = self.sigma_sq
+            # the means moved by at most the drift (drift[-1] = 0 for the padding)
+            lower = lower - np.max(drift[G_n], axis=1)
+            G_n_log_joint_xc = np.full((N, W), -np.inf, dtype=self.dtype)
+            evaluated = G_n < 0
+            n_evals = 0
+
+            rows = np.nonzero(valid)[0]
+            K_log_joint_xc = self._log_joint_p_of_x_and_c(X[rows], K=K_old[rows], X_sq=X_sq[rows])
+            n_evals += K_log_joint_xc.size
+            # distance to the farthest cluster in K(n)
+            upper = np.sqrt(-2. * sigma_sq * np.min(K_log_joint_xc, axis=1))
+            keep = upper < lower[rows]
+            match = G_n[rows, :, np.newaxis] == K_old[rows, np.newaxis, :]
+            in_K = np.any(match, axis=2)
+            G_n_log_joint_xc[rows] = np.where(
+                in_K, K_log_joint_xc[np.arange(rows.size)[:, np.newaxis], np.argmax(match, axis=2)], -np.inf)
+            evaluated[rows] |= in_K
+            if random_c.shape[1] > 0:
+                # the random cluster is not covered by the bound
+                random_log_joint_xc = self._log_joint_p_of_x_and_c(X[rows], K=random_c[rows], X_sq=X_sq[rows])
+                n_evals += random_log_joint_xc.size
+                is_random = (G_n[rows] == random_c[rows]) & ~in_K
+                G_n_log_joint_xc[rows] = np.where(is_random, random_log_joint_xc, G_n_log_joint_xc[rows])
+                evaluated[rows] |= is_random
+                keep &= ~np.any(is_random, axis=1) | (random_log_joint_xc[:, 0] < np.min(K_log_joint_xc, axis=1))
+
+            # evaluate the remaining candidates of all other data points
+            full = np.ones((N), dtype=bool)
+            full[rows[keep]] = False
+            todo = np.where(evaluated[full], -1, G_n[full])
+            remaining_log_joint_xc = self._log_joint_p_of_x_and_c(X[full], K=todo, X_sq=X_sq[full])
+            n_evals += np.count_nonzero(todo >= 0)
+            G_n_log_joint_xc[full] = np.where(todo >= 0, remaining_log_joint_xc, G_n_log_joint_xc[full])
+
+            # lower bound: distance to the (Cprime+1)-th closest candidate
+            if W > Cprime:
+                excluded = -np.partition(-G_n_log_joint_xc[full], Cprime, axis=1)[:, Cprime]
+                lower[full] = np.sqrt(-2. * sigma_sq * excluded.astype(np.float64))
+            else:
+                lower[full] = np.inf
+            return G_n_log_joint_xc, n_evals, (lower, full)
 
-            return K, G_n_log_joint_xc
+        update_G_c = G_c is None
+        if not update_G_c:
+            # fixed neighbors, e.g. for all chunks of a streamed pass
+            G_c_old = G_c
 
-        if algorithm == 'var-GMM-X':
+        elif algorithm == 'var-GMM-X':
             # --- choose the neighbors of C as nearest neighboring
-            # --- clusters by directly calculating the cluster distances
-
-            # do C^2 distance evaluations
-            # distances = np.zeros((C, C))
-            # for i in range(C-1):
-            #     distances[i,i+1:] = self._distance(self.means[i], self.means[i+1:,:], countevals=countevals)
-            #     distances[i+1:,i] = distances[i,i+1:]
-            distances = self._distance(self.means[:, np.newaxis, :], self.means[np.newaxis, :, :],
-                                       countevals=countevals)
+            # --- clusters of the current means
 
             # set neighbors G_c of clusters c by shortest distances
-            G_c = np.argpartition(distances, G - 1, axis=1)[:, :G]
-
-            # update variational parameters K(n)
-            K, G_n_log_joint_xc = update_K(G_c, Cprime, add_random_c, countevals)
-
-            # truncate log-joint to the Cprime values in K(n)
-            log_joint_xc = truncate(G_n_log_joint_xc, K, fill=-np.inf)
+            G_c = self._nearest_means(G, countevals=countevals)
+            G_c_old = G_c
 
         elif algorithm == 'var-GMM-S':
             # --- choose the neighbors of cluster c based on the mean
             # --- responsibility of all data points belonging to the cluster
+            G_c_old = self.G_c
+
+        if algorithm == 'var-GMM-S':
+            # (cluster, candidate) keys, sums and counts of the finite
+            # log-joints of the data points belonging to each cluster
+            neighbor_keys = np.zeros((0), dtype=np.int64)
+            neighbor_stats = np.zeros((0, 2), dtype=np.float64)
+            # clusters that entered or left K(n) of any data point
+            touched = np.zeros((C), dtype=bool)
+
+        # stream over blocks of data points, only K(n), the truncated
+        # log-joints and the posteriors are stored for all data points
+        W = Cprime * G_c_old.shape[1] + int(add_random_c)
+        n_threads = max(1, int(self.params['n_threads']))
+        chunk_size = max(1, min(self._chunk_size(W, D), -(-my_N // n_threads)))
+
+        # draw the random clusters up front, so that the result does not
+        # depend on the order in which the blocks are processed
+        # (append random C into G_c[K_n])
+        random_c = np.random.choice(C, (my_N, int(add_random_c))).astype(np.int32)
+        # make sure the norms of the means are cached before the threads start
+        self._sq_norms(self.means, 'means')
+
+        K = np.empty((my_N, Cprime), dtype=np.int32)
+        log_joint_xc = np.empty((my_N, Cprime), dtype=self.dtype)
+        resp = np.empty((my_N, Cprime), dtype=self.dtype)
+
+        prune = (self.params['prune'] if prune is None else prune) and Cprime < C and algorithm == 'var-GMM-X'
+        if prune:
+            # Hamerly-style bounds: reduce the lower bounds by the drift
+            # of the means since the last E-step (C distance evaluations)
+            bounds = self._bounds
+            bounds['n_e_steps'] += 1
+            drift = np.zeros((C + 1), dtype=np.float64)
+            if bounds['means'] is not None:
+                drift[:C] = np.sqrt(np.sum(np.square(self.means - bounds['means'], dtype=np.float64), axis=1))
+                if countevals:
+                    self._count_distevals(C)
+            bounds['means'] = self.means
+            # the bounds only cover the candidates they were computed
+            # for, so they expire when the neighbors of a cluster change
+            G_c_sorted = np.sort(G_c_old, axis=1)
+            changed = np.ones((C), dtype=bool) if bounds['G_c'] is None or bounds['G_c'].shape != G_c_sorted.shape \
+                else np.any(bounds['G_c'] != G_c_sorted, axis=1)
+            bounds['row_stamp'][changed] = bounds['n_e_steps']
+            bounds['G_c'] = G_c_sorted
+
+        def e_step_block(block):
+            """ E-step for the data points X[block], writes K(n), the
+            log-joints and the posteriors of the block and returns its
+            partial sums """
+            my_X = np.asarray(X[block])
 
             # update variational parameters K(n)
             # K : shape(N,Cprime)
-            # G_n_log_joint_xc : shape(N,Cprime)
-            K, G_n_log_joint_xc = update_K(self.G_c, Cprime, add_random_c, countevals)
-
-            # truncate log-joint to the Cprime values in K(n)
-            # shape(N,C)
-            log_joint_xc = truncate(G_n_log_joint_xc, K, fill=-np.inf)
-            # print("log shape:", log_joint_xc.shape)
-
-            # derive new neighbors from the mean of all cluster data points
-            cluster_datapoints = np.argmax(G_n_log_joint_xc, axis=1)
-            G_c = np.empty((C, self.params['G'])).astype(np.int32)
-            for c in range(C):
-                # c in I_c
-                cluster_distances = G_n_log_joint_xc[cluster_datapoints == c, :]
-
-                # all_cluster_distances = np.concatenate(comm.allgather(cluster_distances))
-                # the following is the buffered (more stable) version of
-                # the above allgather command:
-                NG = comm.allgather(cluster_distances.shape[0])
-                displacements = np.cumsum([0] + NG[:-1])
-                all_cluster_distances = np.zeros((np.sum(np.asarray(NG)), C), dtype=np.float64)
-                comm.Barrier()
-                comm.Allgatherv(
-                    cluster_distances,
-                    [all_cluster_distances,
-                     np.asarray(NG) * C,
-                     displacements * C,
-                     MPI.DOUBLE])
-                mask = ~np.isfinite(all_cluster_distances)
-                masked_cluster_distances = np.ma.array(all_cluster_distances, mask=mask)
-                mean_cluster_distance = masked_cluster_distances.mean(axis=0)
-                mean_cluster_distance = np.ma.filled(mean_cluster_distance, -np.inf)
-                mean_cluster_distance[c] = 0.
-                G_c[c] = np.argpartition(mean_cluster_distance, C - G)[-G:]
-
-        # calculate posteriors (aka 'responsibilities')
-        resp = _softmax(log_joint_xc)
-        stats = {'posterior': resp, 'log_joint_xc': log_joint_xc}
+            # log_joint_xc : shape(N,Cprime), truncated to the values in K(n)
+            # G_n, G_n_log_joint_xc : shape(N,W)
+            K_old = self.K[block]
+            block_bounds = None
+            if prune:
+                valid = bounds['stamp'][block] >= np.max(bounds['row_stamp'][K_old], axis=1)
+                block_bounds = (bounds['lower'][block], valid)
+            K[block], log_joint_xc[block], G_n, G_n_log_joint_xc, n_evals, block_bounds = update_K(
+                my_X, X_sq[block], K_old, G_c_old, Cprime, random_c[block], block_bounds)
+            if prune:
+                # a new bound covers the next search space only if K(n) is unchanged
+                bounds['lower'][block], full = block_bounds
+                same_K = np.all(np.sort(K[block], axis=1) == np.sort(K_old, axis=1), axis=1)
+                bounds['stamp'][block][full] = np.where(same_K[full], bounds['n_e_steps'], -1)
+
+            # calculate posteriors (aka 'responsibilities')
+            resp[block] = _softmax(log_joint_xc[block])
+
+            # sufficient statistics of the M-step (of the weighted posteriors)
+            block_resp = resp[block] if weight is None else resp[block] * weight[block, np.newaxis]
+            block_stats = self.kernels.sufficient_statistics(my_X, X_sq[block], K[block], block_resp, C)
+
+            block_neighbor_stats = None
+            if algorithm == 'var-GMM-S':
+                # log-joints of the search spaces per
+                # (cluster of the data point, candidate cluster)
+                cluster_datapoints = G_n[np.arange(G_n.shape[0]), np.argmax(G_n_log_joint_xc, axis=1)]
+                mask = np.isfinite(G_n_log_joint_xc)
+                keys = (cluster_datapoints[:, np.newaxis].astype(np.int64) * C + G_n)[mask]
+                values = np.stack([G_n_log_joint_xc[mask], np.ones(keys.size)], axis=1)
+                changed = np.any(np.sort(K[block], axis=1) != np.sort(K_old, axis=1), axis=1)
+                block_touched = np.zeros((C), dtype=bool)
+                block_touched[K[block][changed]] = True
+                block_touched[K_old[changed]] = True
+                block_neighbor_stats = _reduce_by_key(keys, values) + (block_touched,)
+
+            return block_stats, n_evals, block_neighbor_stats
+
+        # time of the work on the local data points (without waiting for
+        # other processes), used to balance the load between processes
+        e_step_start = timer()
+        blocks = [slice(start, min(start + chunk_size, my_N)) for start in range(0, my_N, chunk_size)]
+        executor = ThreadPoolExecutor(n_threads) if n_threads > 1 else None
+        results = executor.map(e_step_block, blocks) if executor is not None else map(e_step_block, blocks)
+
+        # reduce the partial sums of the blocks (in block order) before
+        # they are reduced between processes in the M-step
+        stats = {'sum_resp': np.zeros((C), dtype=np.float64),
+                 'sum_x': np.zeros((C, D), dtype=np.float64),
+                 'sum_x2': np.zeros((C), dtype=np.float64)}
+        # (with compensated summation, the errors are carried over)
+        errors = {key: 0. for key in stats}
+        ndistevals = 0
+        for block_stats, block_ndistevals, block_neighbor_stats in results:
+            for key, value in zip(['sum_resp', 'sum_x', 'sum_x2'], block_stats):
+                stats[key], errors[key] = SCS(stats[key], value + errors[key])
+            ndistevals += block_ndistevals
+            if block_neighbor_stats is not None:
+                neighbor_keys, neighbor_stats = _reduce_by_key(
+                    np.concatenate([neighbor_keys, block_neighbor_stats[0]]),
+                    np.concatenate([neighbor_stats, block_neighbor_stats[1]]))
+                touched |= block_neighbor_stats[2]
+        for key in stats:
+            stats[key] += errors[key]
+        stats['N'] = my_N if weight is None else np.sum(weight, dtype=np.float64)
+        if executor is not None:
+            executor.shutdown()
+        self.e_step_time = timer() - e_step_start
+        if countevals:
+            self._count_distevals(ndistevals)
+        if reduce_stats:
+            stats['reduction'] = self._reduce_stats(stats)
+
+        if algorithm == 'var-GMM-S':
+            if update_G_c:
+                # derive new neighbors from the mean of all cluster data points
+                G_c = self._update_neighbors(neighbor_keys, neighbor_stats, touched, G_c_old, countevals)
+            else:
+                stats.update({'neighbor_keys': neighbor_keys, 'neighbor_stats': neighbor_stats, 'touched': touched})
+
+        stats.update({'posterior': resp, 'log_joint_xc': log_joint_xc, 'K': K})
         return stats, K, G_c
 
-    def _m_step(self, X, stats, theta):
-        """M step.
+    def _update_neighbors(self, neighbor_keys, neighbor_stats, touched, G_c_old, countevals=False):
+        """ var-GMM-S: new neighbors G_c from the process local neighbor
+        statistics of an E-step
 
-        Parameters
-        ----------
-        X : array-like, shape (n_samples, n_features)
-            Training data
+        neighbor_keys : integer array, shape (n_keys, )
+            keys cluster * C + candidate
 
-        resp : array-like, shape (n_samples, n_components)
-            Posterior probabilities (or responsibilities) of the point
-            of each sample in X.
+        neighbor_stats : array-like, shape (n_keys, 2)
+            sums and counts of the finite log-joints of the candidates of
+            the data points belonging to each cluster
+
+        touched : boolean array, shape (C, )
+            clusters that entered or left K(n) of any local data point
+
+        G_c_old : integer array, shape (C components, G components)
+            current neighbors
+
+        countevals : boolean
+            If True the distance evaluations are counted.
 
         Returns
         -------
-        theta : dictionary {'means', 'sigma_sq'}
-            Updated model parameters.
+        G_c : integer numpy array, shape (C components, G components)
         """
         comm = self.comm
-        rank = comm.rank
-
-        my_N, D = X.shape
-        N = np.empty((1), dtype='int32')
-        comm.Allreduce(np.asarray(my_N, dtype='int32'), N, op=MPI.SUM)
         C = self.params['C']
-        log_joint_xc = stats['log_joint_xc']
-        resp = stats['posterior']
-
-        sum_resp = np.empty((C), dtype='float64')
-        comm.Allreduce([np.sum(resp, axis=0), MPI.DOUBLE], [sum_resp, MPI.DOUBLE], op=MPI.SUM)
-
-        # --- mu ---
-        my_means = np.tensordot(resp, X, axes=(0, 0))  # not include the weight \gamma_n
-        means = np.empty((C, D), dtype=np.float64)
-        comm.Allreduce([my_means, MPI.DOUBLE], [means, MPI.DOUBLE], op=MPI.SUM)
-        means[sum_resp != 0] /= sum_resp[sum_resp != 0, np.newaxis]
-        theta['means'] = means
+        G = G_c_old.shape[1]
+
+        # lazy refresh: rows of clusters whose means drifted by less
+        # than params['neighbor_tol'] since their last refresh, and
+        # that did not enter or leave any K(n), are reused
+        refresh = np.ones((C), dtype=bool)
+        if self.params['neighbor_tol'] is not None and self.drift is not None:
+            self._G_c_drift += self.drift
+            if countevals:
+                self._count_distevals(C)
+            touched = comm.allreduce(touched.astype(np.int32)) > 0
+            refresh = touched | (self._G_c_drift > self.params['neighbor_tol'])
+            self._G_c_drift[refresh] = 0.
+            # only the statistics of the refreshed rows are exchanged
+            keep = refresh[neighbor_keys // C]
+            neighbor_keys, neighbor_stats = neighbor_keys[keep], neighbor_stats[keep]
+        if self.n_iteration > 0:
+            self.G_c_refreshed[self.n_iteration - 1] = np.count_nonzero(refresh)
+            self.G_c_reused[self.n_iteration - 1] = C - np.count_nonzero(refresh)
+
+        # gather the locally reduced (key, sum, count) triples of all
+        # processes in a single collective and reduce them by key
+        # (keys < C^2 are exact in float64)
+        packed = np.concatenate([neighbor_keys[:, np.newaxis].astype(np.float64), neighbor_stats], axis=1)
+        packed = comm.allgatherv(packed)
+        neighbor_keys, neighbor_stats = _reduce_by_key(packed[:, 0].astype(np.int64), packed[:, 1:])
+
+        # mean over the finite log-joints of each (cluster, candidate),
+        # c in I_c: the cluster itself is always the best candidate
+        neighbor_keys, first = np.unique(
+            np.concatenate([np.arange(C, dtype=np.int64) * (C + 1), neighbor_keys]), return_index=True)
+        mean_cluster_distance = np.concatenate(
+            [np.zeros((C)), neighbor_stats[:, 0] / neighbor_stats[:, 1]])[first]
+        owners, candidates = neighbor_keys // C, (neighbor_keys % C).astype(np.int32)
+        mean_cluster_distance[owners == candidates] = 0.
+
+        # the G candidates with the largest means per cluster
+        order = np.lexsort((-mean_cluster_distance, owners))
+        owners, candidates = owners[order], candidates[order]
+        counts = np.bincount(owners, minlength=C)
+        position = np.arange(owners.size) - np.repeat(np.cumsum(counts) - counts, counts)
+        G_c = G_c_old.astype(np.int32)
+        complete = counts >= G
+        G_c[complete] = candidates[(position < G) & complete[owners]].reshape(-1, G)
+        # clusters with less than G visited candidates are filled up
+        # with unvisited ones
+        for c in np.nonzero(~complete & refresh)[0]:
+            row = np.full((C), -np.inf)
+            row[candidates[owners == c]] = mean_cluster_distance[order][owners == c]
+            G_c[c] = np.argpartition(row, C - G)[-G:]
+        return G_c
+
+    def _reduce_stats(self, stats):
+        """ start the reduction of the sufficient statistics and of the
+        (weighted) number of data points between processes, packed into
+        a single float64 buffer [sum_resp | sum_x | sum_x2 | N]
+
+        stats : dictionary {'sum_resp', 'sum_x', 'sum_x2', 'N', ...}
+            process local sufficient statistics
 
-        # --- sigma_sq ---
-        my_sum_X2 = np.zeros((C), dtype=np.float64)
-        for r, x in zip(resp, X):
-            X2_term = r * np.inner(x, x)
-            # my_sum_X2, sum_error = SCS(my_sum_X2, X2_term + sum_error)
-            my_sum_X2 += X2_term
-        sum_X2 = np.empty((C), dtype=np.float64)
-        comm.Allreduce([my_sum_X2, MPI.DOUBLE], [sum_X2, MPI.DOUBLE], op=MPI.SUM)
-        Mu2 = np.asarray([np.inner(mean, mean) for mean in means])
-        sigma_sq = np.sum(sum_X2 - Mu2 * sum_resp)
-        N = np.empty((1), dtype='int32')
-        comm.Allreduce(np.asarray(my_N, dtype='int32'), N, op=MPI.SUM)
-        sigma_sq = sigma_sq / float(N * D)
-        theta['sigma_sq'] = sigma_sq
+        Returns
+        -------
+        reduction : utils.comm.Request
+            reduction.wait() returns the packed sums (see _unpack_stats)
+        """
+        packed = np.concatenate([stats['sum_resp'], stats['sum_x'].ravel(), stats['sum_x2'], [stats['N']]])
+        return self.comm.iallreduce(packed)
 
-        return theta
+    def _unpack_stats(self, packed, D):
+        """ sum_resp, sum_x, sum_x2 (float64 arrays) and the (weighted)
+        number of data points N (float) from a buffer packed by
+        _reduce_stats """
+        C = self.params['C']
+        sum_resp, sum_x, sum_x2 = packed[:C], packed[C:C + C * D].reshape(C, D), packed[C + C * D:C + C * D + C]
+        return sum_resp, sum_x, sum_x2, float(packed[-1])
 
-    def _m_step_weight(self, X, stats, theta, weight):
+    def _m_step(self, X, stats, theta):
         """M step.
 
         Parameters
@@ -946,50 +1443,36 @@ class TruncatedGaussianMixture(object):
         X : array-like, shape (n_samples, n_features)
             Training data
 
-        resp : array-like, shape (n_samples, n_components)
-            Posterior probabilities (or responsibilities) of the point
-            of each sample in X.
+        stats : dictionary {'sum_resp', 'sum_x', 'sum_x2', 'N', ...}
+            Process local sufficient statistics accumulated by the E-step:
+            the summed (weighted) responsibilities, the responsibility
+            weighted sums of the data points and of their squared norms
+            per cluster, and the (weighted) number of data points.
 
         Returns
         -------
         theta : dictionary {'means', 'sigma_sq'}
             Updated model parameters.
         """
-        comm = self.comm
-        rank = comm.rank
+        D = X.shape[1]
 
-        my_N, D = X.shape
-        N = np.empty((1), dtype='int32')
-        comm.Allreduce(np.asarray(my_N, dtype='int32'), N, op=MPI.SUM)
-        C = self.params['C']
-        log_joint_xc = stats['log_joint_xc']
-        resp = stats['posterior']
-
-        sum_resp = np.empty((C), dtype='float64')
-        comm.Allreduce([np.sum(resp, axis=0), MPI.DOUBLE], [sum_resp, MPI.DOUBLE], op=MPI.SUM)
+        # the statistics of all processes in one (packed) reduction
+        reduction = stats['reduction'] if 'reduction' in stats else self._reduce_stats(stats)
+        sum_resp, means, sum_X2, N = self._unpack_stats(reduction.wait(), D)
 
         # --- mu ---
-        #
-        my_means = np.tensordot(resp, X, axes=(0, 0))
-        means = np.empty((C, D), dtype=np.float64)
-        comm.Allreduce([my_means, MPI.DOUBLE], [means, MPI.DOUBLE], op=MPI.SUM)
         means[sum_resp != 0] /= sum_resp[sum_resp != 0, np.newaxis]
-        theta['means'] = means
+        self.drift = np.sqrt(np.sum(np.square(means - theta['means']), axis=1))
 
         # --- sigma_sq ---
-        my_sum_X2 = np.zeros((C), dtype=np.float64)
-        for r, x in zip(resp, X):
-            X2_term = r * np.inner(x, x)
-            # my_sum_X2, sum_error = SCS(my_sum_X2, X2_term + sum_error)
-            my_sum_X2 += X2_term
-        sum_X2 = np.empty((C), dtype=np.float64)
-        comm.Allreduce([my_sum_X2, MPI.DOUBLE], [sum_X2, MPI.DOUBLE], op=MPI.SUM)
-        Mu2 = np.asarray([np.inner(mean, mean) for mean in means])
+        Mu2 = self._sq_norms(means, 'means')
         sigma_sq = np.sum(sum_X2 - Mu2 * sum_resp)
-        N = np.empty((1), dtype='int32')
-        comm.Allreduce(np.asarray(my_N, dtype='int32'), N, op=MPI.SUM)
-        sigma_sq = sigma_sq / float(N * D)
+        sigma_sq = sigma_sq / (N * D)
         theta['sigma_sq'] = sigma_sq
+        # sigma_sq is derived from the float64 means, they are stored
+        # in the compute dtype afterwards
+        theta['means'] = means.astype(self.dtype, copy=False)
+
         return theta
 
     def free_energy(self, X, theta=None, resp=None, distributed=False):
@@ -1003,9 +1486,9 @@ class TruncatedGaussianMixture(object):
         theta : dictionary
             Model parameters for free energy calculation.
 
-        resp : array-like, shape (n_samples, n_components)
+        resp : array-like, shape (n_samples, Cprime)
             Posterior probabilities (or responsibilities) of the point
-            of each sample in X.
+            of each sample in X for the clusters in K(n).
 
         distributed : boolean (default:True)
             Denote if the data is already distributed between processes or not.
@@ -1026,8 +1509,8 @@ class TruncatedGaussianMixture(object):
 
         # split data between processes if not already distributed
         if not distributed:
-            my_n = [i for i in range(X.shape[0]) if i * size // X.shape[0] == rank]
-            my_X = X[my_n]
+            my_n = self._my_rows(X.shape[0])
+            my_X = np.asarray(X[my_n], dtype=self.dtype)
             if resp is not None:
                 my_resp = resp[my_n]
             else:
@@ -1075,23 +1558,16 @@ class TruncatedGaussianMixture(object):
         my_N, D = my_X.shape
         comm = self.comm
 
-        my_free_energy = 0.
-        for n in range(my_N):
-            my_free_energy_n = np.zeros((K[n].shape[0]))
-            for i, c in enumerate(K[n]):
-                my_free_energy_n[i] += multivariate_normal.logpdf(
-                    my_X[n],
-                    means[c],
-                    sigma_sq * np.eye((D)),
-                    allow_singular=True
-                )
-            shift = np.max(my_free_energy_n) - 707. + np.log(C)
-            my_free_energy += np.log(np.sum(np.exp(my_free_energy_n - shift))) + shift
-        free_energy = np.zeros(1, dtype='float64')
-        comm.Allreduce(my_free_energy, free_energy, op=MPI.SUM)
-        N = np.empty((1), dtype='int32')
-        comm.Allreduce(np.asarray(my_N, dtype='int32'), N, op=MPI.SUM)
-        free_energy = -np.log(C) + free_energy[0] / float(N)
+        # log N(x_n; mu_c, sigma_sq*1) for the Cprime clusters in K(n)
+        # shape(N,Cprime)
+        sq_distance = self.kernels.candidate_sq_distances(my_X, means, K, self._sq_norms(means, 'means'),
+                                                          self._sq_norms(my_X, 'X'))
+        my_free_energy_n = -float(D) / 2. * np.log(2. * np.pi * sigma_sq) - sq_distance / (2. * sigma_sq)
+        shift = np.max(my_free_energy_n, axis=1, keepdims=True) - 707. + np.log(C)
+        my_free_energy = np.sum(np.log(np.sum(np.exp(my_free_energy_n - shift), axis=1)) + shift[:, 0])
+        free_energy = comm.allreduce(np.asarray(my_free_energy, dtype='float64'))
+        N = comm.allreduce(np.asarray(my_N, dtype='int32'))
+        free_energy = -np.log(C) + free_energy / float(N)
         return free_energy
 
     def _free_energy_GMM_isotropic_truncated_18(self, resp, D, sigma_sq):
@@ -1100,9 +1576,9 @@ class TruncatedGaussianMixture(object):
 
         Parameters
         ----------
-        resp : array-like, shape (n_samples, n_components)
+        resp : array-like, shape (n_samples, Cprime)
             Posterior probabilities (or responsibilities) of the point
-            of each sample in X.
+            of each sample in X for the clusters in K(n).
 
         D : integer
             Data dimensionality.
@@ -1118,15 +1594,13 @@ class TruncatedGaussianMixture(object):
         C = self.params['C']
 
         my_N = resp.shape[0]
-        N = np.empty((1), dtype='int32')
-        comm.Allreduce(np.asarray(my_N, dtype='int32'), N, op=MPI.SUM)
+        N = comm.allreduce(np.asarray(my_N, dtype='int32'))
 
         my_sum_resp = np.sum((resp[resp > 0] * np.log(resp[resp > 0])))
-        sum_resp = np.empty((1), dtype='int32')
-        comm.Allreduce(np.asarray(my_sum_resp, dtype='int32'), sum_resp, op=MPI.SUM)
+        sum_resp = comm.allreduce(np.asarray(my_sum_resp, dtype='int32'))
 
         free_energy = -np.log(C) - float(D) / 2. * np.log(2. * np.pi * np.e * sigma_sq) \
-                      - 1. / float(N) * sum_resp[0]
+                      - 1. / float(N) * sum_resp
         return free_energy
 
     def _free_energy_GMM_isotropic_13(self, D, sigma_sq=None):
@@ -1205,16 +1679,14 @@ class TruncatedGaussianMixture(object):
         C = self.params['C']
         comm = self.comm
 
-        N = np.empty((1), dtype='int32')
-        comm.Allreduce(np.asarray(my_N, dtype='int32'), N, op=MPI.SUM)
+        N = comm.allreduce(np.asarray(my_N, dtype='int32'))
         my_loglikelihood = 0.
-        for x in my_X:
-            exp_arg = -1. / (2. * theta['sigma_sq']) * np.square(np.linalg.norm(x - theta['means'], axis=1))
-            shift = np.max(exp_arg) - 707. + np.log(C)
-            my_loglikelihood += np.log(np.sum(np.exp(exp_arg - shift))) + shift
-        loglikelihood = np.zeros(1, dtype='float64')
-        comm.Allreduce(my_loglikelihood, loglikelihood, op=MPI.SUM)
-        loglikelihood = -np.log(C) - D / 2. * np.log(2. * np.pi * theta['sigma_sq']) + 1. / float(N) * loglikelihood[0]
+        for _, sq_distance in self._sq_distance_blocks(my_X, theta['means']):
+            exp_arg = -1. / (2. * theta['sigma_sq']) * sq_distance
+            shift = np.max(exp_arg, axis=1, keepdims=True) - 707. + np.log(C)
+            my_loglikelihood += np.sum(np.log(np.sum(np.exp(exp_arg - shift), axis=1)) + shift[:, 0])
+        loglikelihood = comm.allreduce(np.asarray(my_loglikelihood, dtype='float64'))
+        loglikelihood = -np.log(C) - D / 2. * np.log(2. * np.pi * theta['sigma_sq']) + 1. / float(N) * loglikelihood
         return loglikelihood
 
     def quantization_error(self, X, means=None, distributed=False):
@@ -1239,11 +1711,11 @@ class TruncatedGaussianMixture(object):
         means = self.means if means is None else means
         my_X = self._distribute(X) if not distributed else X
 
-        my_closest_cluster = [np.argmin(np.linalg.norm(x - means, axis=1)) for x in my_X]
-        my_q_error = np.sum(np.square(np.linalg.norm(means[my_closest_cluster] - my_X)))
-        q_error = np.zeros((1), dtype='float64')
-        self.comm.Reduce(my_q_error, q_error, op=MPI.SUM, root=0)
-        return q_error[0]
+        my_q_error = 0.
+        for _, sq_distance in self._sq_distance_blocks(my_X, means):
+            my_q_error += np.sum(np.min(sq_distance, axis=1))
+        q_error = self.comm.reduce(np.asarray(my_q_error, dtype='float64'), root=0)
+        return q_error if q_error is not None else 0.
 
     def clustering_scores(self, X, y_true, means=None, distributed=False):
         """Purity, NMI and AMI scores
@@ -1277,7 +1749,9 @@ class TruncatedGaussianMixture(object):
         my_N, D = my_X.shape
 
         # closest cluster to each X
-        my_closest_cluster = [np.argmin(np.linalg.norm(x - means, axis=1)) for x in my_X]
+        my_closest_cluster = np.empty((my_N), dtype=np.int64)
+        for block, sq_distance in self._sq_distance_blocks(my_X, means):
+            my_closest_cluster[block] = np.argmin(sq_distance, axis=1)
         closest_cluster = np.concatenate(comm.allgather(my_closest_cluster))
 
         # classify cluster by most frequent labels
@@ -1298,7 +1772,7 @@ class TruncatedGaussianMixture(object):
         # AMI_score = metrics.adjusted_mutual_info_score(y_true, y_pred, average_method='warn')
         return purity_score, NMI_score, AMI_score
 
-    def _log_joint_p_of_x_and_c(self, my_X, means=None, sigma_sq=None, K=None, countevals=False):
+    def _log_joint_p_of_x_and_c(self, my_X, means=None, sigma_sq=None, K=None, X_sq=None, countevals=False):
         """Calculate p(x^{(n)},c|\theta)
 
         Parameters
@@ -1312,33 +1786,48 @@ class TruncatedGaussianMixture(object):
         sigma_sq : float
             Common sigma^2 for isotropic GMMs.
 
-        K : array-like, shape (n_samples, Cprime)
-            Index set of non-zero entries.
+        K : array-like, shape (n_samples, W)
+            Index set of the clusters to evaluate, padded with -1.
+
+        X_sq : array-like, shape (n_samples, )
+            Squared norms of the data points.
 
         countevalse : boolean
             True: count number of evaluations
 
         Returns
         -------
-        log_joint_xc : float
+        log_joint_xc : numpy array, shape (n_samples, W)
+            log-joints for the clusters in K, -inf for the padding
         """
         means = self.means if means is None else means
         sigma_sq = self.sigma_sq if sigma_sq is None else sigma_sq
         # search space
         K = self.K if K is None else K
 
-        my_N = my_X.shape[0]
-        C = self.params['C']
+        my_N, D = my_X.shape
+        valid = K >= 0
+
+        # ||x||^2 - 2 x.mu + ||mu||^2 over blocks of rows, so that the
+        # gathered means of a block stay small
+        means_sq = self._sq_norms(means, 'means')
+        X_sq = self._sq_norms(my_X, 'X') if X_sq is None else X_sq
+        block = self._chunk_size(K.shape[1], D)
+        log_joint_xc = np.empty(K.shape, dtype=self.dtype)
+        for start in range(0, my_N, block):
+            stop = min(start + block, my_N)
+            sq_distance = self.kernels.candidate_sq_distances(my_X[start:stop], means, K[start:stop], means_sq,
+                                                              X_sq[start:stop])
+            log_joint_xc[start:stop] = -1. / (2. * sigma_sq) * sq_distance
+        log_joint_xc[~valid] = -np.inf
 
-        log_joint_xc = (-np.inf) * np.ones((my_N, C), dtype=np.float64)
-        for n, (k, x) in enumerate(zip(K, my_X)):
-            log_joint_xc[n, k] = (-1. / (2. * sigma_sq) * np.square(
-                self._distance(x, means[k], countevals=countevals, distributed=True)))
+        if countevals:
+            self._count_distevals(np.count_nonzero(valid))
 
         return log_joint_xc
 
     def _distance(self, X, means, countevals=False, distributed=True):
-        """ calculate euclidean distance
+        """ calculate euclidean distances between all data points and all means
 
         X : array-like, shape (n_samples, n_features)
             Input training data.
@@ -1349,23 +1838,374 @@ class TruncatedGaussianMixture(object):
         distributed : boolean (default:True)
             Denote if the data is already distributed between processes or not.
             If not it is assumed, that each process holds the same data.
+
+        Returns
+        -------
+        distance : numpy array, shape (n_samples, n_components)
         """
 
         my_X = self._distribute(X) if not distributed else X
 
-        distance = np.linalg.norm(my_X - means, axis=-1)
+        distance = np.empty((my_X.shape[0], means.shape[0]), dtype=np.float64)
+        for block, sq_distance in self._sq_distance_blocks(my_X, means):
+            distance[block] = np.sqrt(sq_distance)
 
         if countevals:
-            self.training_time += timer() - self.start_time
-            my_N = my_X.shape[0] if len(my_X.shape) >= 2 else 1
-            C = means.shape[-2] if len(means.shape) >= 2 else 1
-            # print(my_N,C,my_N*C)
-            # print(asd)
-            self.ndistevals[self.n_iteration - 1] += my_N * C
-            self.start_time = timer()
+            self._count_distevals(my_X.shape[0] * means.shape[0])
 
         return distance
 
+    def _initial_K(self, my_X, Cprime):
+        """ initial index sets K(n), depending on params['init_K']
+
+        'random': C' distinct random clusters per data point.
+        'projection': approximately nearest means. The data points and
+        the means are projected onto params['n_projections'] random
+        directions. Along each direction the C' means on either side of
+        a data point are found by binary search in the sorted projected
+        means, and the C' closest of these candidates form K(n).
+
+        my_X : array-like, shape (n_samples, n_features)
+            Distributed input data.
+
+        Cprime : integer
+            |K(n)| size of K(n)
+
+        Returns
+        -------
+        K : integer numpy array, shape (n_samples, Cprime)
+        """
+        assert self.params['init_K'] in ['random', 'projection'], "init_K must be 'random' or 'projection'"
+        C = self.params['C']
+        my_N, D = my_X.shape
+        if self.params['init_K'] == 'random':
+            if Cprime ** 2 <= 4 * C:
+                # draw with replacement and redraw the rows with duplicates
+                # (a row has no duplicates with probability > exp(-2))
+                K = np.random.randint(C, size=(my_N, Cprime)).astype(np.int32)
+                redraw = np.arange(my_N)
+                while redraw.size > 0:
+                    sorted_K = np.sort(K[redraw], axis=1)
+                    redraw = redraw[np.any(sorted_K[:, 1:] == sorted_K[:, :-1], axis=1)]
+                    K[redraw] = np.random.randint(C, size=(redraw.size, Cprime))
+                return K
+            # the Cprime clusters with the smallest random keys, in blocks
+            K = np.empty((my_N, Cprime), dtype=np.int32)
+            chunk_size = self._chunk_size(C, 0)
+            for start in range(0, my_N, chunk_size):
+                keys = np.random.rand(min(chunk_size, my_N - start), C)
+                K[start:start + keys.shape[0]] = np.argpartition(keys, Cprime - 1, axis=1)[:, :Cprime]
+            return K
+
+        directions = np.random.randn(D, int(self.params['n_projections'])).astype(self.dtype)
+        directions /= np.linalg.norm(directions, axis=0)
+        projected_means = np.dot(self.means, directions)
+        order = np.argsort(projected_means, axis=0)
+        sorted_means = np.take_along_axis(projected_means, order, axis=0)
+        width = min(2 * Cprime, C)
+        window = np.arange(width)
+
+        K = np.empty((my_N, Cprime), dtype=np.int32)
+        chunk_size = self._chunk_size(width * directions.shape[1], D)
+        for start in range(0, my_N, chunk_size):
+            block = slice(start, min(start + chunk_size, my_N))
+            projected_X = np.dot(my_X[block], directions)
+            G_n = np.concatenate([
+                order[np.clip(np.searchsorted(sorted_means[:, p], projected_X[:, p]) - Cprime, 0, C - width)[
+                          :, np.newaxis] + window, p]
+                for p in range(directions.shape[1])], axis=1)
+            # unique candidates, duplicates replaced by -1
+            G_n = np.sort(G_n, axis=1).astype(np.int32)
+            G_n[:, 1:][G_n[:, 1:] == G_n[:, :-1]] = -1
+            G_n_log_joint_xc = self._log_joint_p_of_x_and_c(my_X[block], K=G_n, X_sq=self._sq_norms(my_X, 'X')[block])
+            K[block], _ = self.kernels.top_candidates(G_n, G_n_log_joint_xc, Cprime)
+        return K
+
+    def _nearest_means(self, G, countevals=False):
+        """ the G nearest means of each mean (including the mean itself)
+
+        Depending on params['neighbor_index'] the queries are answered by
+        a KD-tree ('kd_tree') or a ball tree ('ball_tree') built over the
+        current means, or by all C^2 distances ('brute'). For the trees
+        only the distances computed by the queries are counted.
+
+        G : integer
+            number of neighbors
+
+        countevals : boolean
+            True: count number of evaluations
+
+        Returns
+        -------
+        G_c : integer numpy array, shape (n_components, G)
+        """
+        index = self.params['neighbor_index']
+        assert index in ['kd_tree', 'ball_tree', 'brute'], "neighbor_index must be 'kd_tree', 'ball_tree' or 'brute'"
+        means = self.means
+        C = means.shape[0]
+        if index == 'brute':
+            # blockwise, so that the C x C distances are never stored
+            G_c = np.empty((C, G), dtype=np.int32)
+            for block, sq_distance in self._sq_distance_blocks(means, means, X_key='means'):
+                G_c[block] = np.argpartition(sq_distance, G - 1, axis=1)[:, :G]
+            ndistevals = C * C
+        else:
+            tree = (KDTree if index == 'kd_tree' else BallTree)(means)
+            G_c = tree.query(means, k=G, return_distance=False).astype(np.int32)
+            ndistevals = tree.get_n_calls()
+        if countevals:
+            self._count_distevals(ndistevals)
+        return G_c
+
+    def _sq_distance_blocks(self, X, means, X_key='X'):
+        """ squared euclidean distances between the data points and all
+        means, blockwise over the data points and using the cached norms
+
+        X : array-like, shape (n_samples, n_features)
+            Input data.
+
+        means : array-like, shape (n_components, n_features)
+            Gaussian means.
+
+        X_key : string
+            cache key of the norms of X (see _sq_norms)
+
+        Yields
+        ------
+        block : slice of the data points
+
+        sq_distance : numpy array, shape (block size, n_components)
+        """
+        X_sq = self._sq_norms(X, X_key)
+        means_sq = self._sq_norms(means, 'means')
+        chunk_size = self._chunk_size(means.shape[0], X.shape[1])
+        for start in range(0, X.shape[0], chunk_size):
+            block = slice(start, min(start + chunk_size, X.shape[0]))
+            sq_distance = X_sq[block, np.newaxis] - 2. * np.dot(X[block], means.T) + means_sq[np.newaxis, :]
+            yield block, np.maximum(sq_distance, 0.)
+
+    def _sq_norms(self, A, key):
+        """ squared norms of the rows of A, cached as long as A is the
+        array stored under key ('X' for the local data points, computed
+        once per fit, or 'means', refreshed once per M-step)
+
+        A : array-like, shape (n, n_features)
+
+        key : string
+        """
+        cached, A_sq = self._norm_cache[key]
+        if cached is not A:
+            # in float64 also for float32 data, as the norms enter sigma_sq
+            A_sq = np.einsum('nd,nd->n', A, A, dtype=np.float64)
+            self._norm_cache[key] = (A, A_sq)
+        return A_sq
+
+    def _chunk_size(self, W, D):
+        """ number of data points processed at once, either given by
+        params['chunk_size'] or derived from params['max_block_bytes']
+
+        W : integer
+            number of candidate clusters per data point
+
+        D : integer
+            number of features
+        """
+        if self.params['chunk_size'] is not None:
+            return max(1, int(self.params['chunk_size']))
+        # gathered candidate means (in float64) plus a few (W,) temporaries per row
+        bytes_per_row = W * (8 * D + 4 * self.dtype.itemsize)
+        return max(1, int(self.params['max_block_bytes']) // bytes_per_row)
+
+    def _initial_G_c(self, C, G):
+        """ random initial neighbors G_c of 'var-GMM-S', making sure
+        that c is in G_c[c] (None for 'var-GMM-X'); the drift of the
+        means since the rows of G_c were refreshed is reset
+
+        C, G : integer
+            number of clusters and of neighbors per cluster
+
+        Returns
+        -------
+        G_c : integer numpy array, shape (C components, G components) or None
+        """
+        if self.params['algorithm'][:9] != 'var-GMM-S':
+            return None
+        self._G_c_drift = np.zeros((C), dtype=np.float64)
+        return np.asarray([
+            np.concatenate(
+                [np.asarray([c]),
+                 np.random.permutation(
+                     np.delete(np.arange(C), np.asarray([c])))
+                 ], axis=0)[:G]
+            for c in range(C)])
+
+    def _iteration_strings(self, n_points, free_energy=None, loglikelihood=None, q_error=None, scores=None):
+        """ output strings of the current iteration for write_indices,
+        values that are None are written as '--'
+
+        n_points : integer
+            number of data points of the E-step (of all processes), the
+            speed-up of the distance evaluations is relative to n_points * C
+
+        scores : tuple (purity, NMI, AMI) or None
+
+        Returns
+        -------
+        strings : list of 8 strings
+            iteration, free energy, log-likelihood, quantization error,
+            purity, NMI, AMI and distance evaluations
+        """
+        C = self.params['C']
+        strn = ('{:' + str(int(np.log10(self.params['Niter']) + 1)) + '}').format(self.n_iteration)
+        strings = [strn] + ['\t{:13.6f}'.format(value) if value is not None else '\t{:13}'.format('--')
+                            for value in [free_energy, loglikelihood, q_error]]
+        strings += ['\t{:8.6f}'.format(score) for score in scores] if scores is not None \
+            else ['\t{:8}'.format('--')] * 3
+        if self.params['VERBOSE']['nd']:
+            ndistevals = self.comm.allreduce(self.ndistevals[self.n_iteration - 1:self.n_iteration])
+            strings.append('\t{}/{} (x{:.2f})'.format(ndistevals[0], n_points * C, n_points * C / ndistevals[0]))
+        else:
+            strings.append('\t{:8}'.format('--'))
+        return strings
+
+    def _record_comm(self, comm_start):
+        """ record the bytes sent and the time spent in collectives since
+        comm_start = (comm.bytes_sent, comm.time) for this iteration """
+        self.comm_bytes[self.n_iteration - 1] = self.comm.bytes_sent - comm_start[0]
+        self.comm_time[self.n_iteration - 1] = self.comm.time - comm_start[1]
+        print('collectives: {} bytes sent, {:.4f}s'.format(self.comm_bytes[self.n_iteration - 1],
+                                                           self.comm_time[self.n_iteration - 1]))
+
+    def _rebalance(self, X, my_X, migrate=True):
+        """ record the E-step times of all processes and, if they differ
+        by more than params['rebalance_tol'] (max / mean - 1), shift the
+        boundaries of the contiguous row ranges such that the estimated
+        E-step times are equal. The E-step time per row is assumed to be
+        constant within the rows of each process. Rows that change the
+        process take their K(n), log-joints and pruning bounds along.
+
+        X : array-like, shape (n_samples, n_features)
+            all data points
+
+        my_X : array-like, shape (my_N, n_features)
+            data points of this process
+
+        migrate : boolean
+            If False, the E-step times are only recorded (default: True).
+
+        Returns
+        -------
+        my_X : array-like, shape (new my_N, n_features)
+            the (possibly new) data points of this process
+        """
+        comm = self.comm
+        size = comm.size
+        times = np.asarray(comm.allgather(self.e_step_time))
+        self.e_step_times[self.n_iteration - 1] = times
+        tol = self.params['rebalance_tol']
+        if not migrate or tol is None or size == 1 or np.max(times) <= (1. + tol) * np.mean(times):
+            return my_X
+
+        # cumulative E-step time at the row boundaries, new boundaries at
+        # equal fractions of the total time
+        N = X.shape[0]
+        old = self._my_rows(N)
+        bounds = np.asarray([0] + [stop for _, stop in comm.allgather((old.start, old.stop))])
+        cumulative = np.concatenate([[0.], np.cumsum(np.maximum(times, 1e-12))])
+        new_bounds = np.round(np.interp(np.linspace(0., cumulative[-1], size + 1), cumulative, bounds)).astype(int)
+        # at least one row per process
+        new_bounds = np.minimum(np.maximum(new_bounds, np.arange(size + 1)), N - size + np.arange(size + 1))
+        new = slice(int(new_bounds[comm.rank]), int(new_bounds[comm.rank + 1]))
+        print('rank {}: E-step {:.3f}s (mean {:.3f}s), rows {}-{} -> {}-{}'.format(
+            comm.rank, times[comm.rank], np.mean(times), old.start, old.stop, new.start, new.stop))
+
+        # per-row state, rows leaving this process are sent to all processes
+        state = [self.K, self.log, self._bounds['lower'], self._bounds['stamp']]
+        rows = np.arange(old.start, old.stop)
+        leaving = (rows < new.start) | (rows >= new.stop)
+        received_rows = comm.allgatherv(rows[leaving])
+        received = [comm.allgatherv(array[leaving]) for array in state]
+        arriving = (received_rows >= new.start) & (received_rows < new.stop)
+        keep = slice(max(old.start, new.start), max(min(old.stop, new.stop), max(old.start, new.start)))
+        for i, array in enumerate(state):
+            new_array = np.empty((new.stop - new.start,) + array.shape[1:], dtype=array.dtype)
+            new_array[keep.start - new.start:keep.stop - new.start] = array[keep.start - old.start:keep.stop - old.start]
+            new_array[received_rows[arriving] - new.start] = received[i][arriving]
+            state[i] = new_array
+        self.K, self.log, self._bounds['lower'], self._bounds['stamp'] = state
+
+        self._rows = (N, new)
+        return np.asarray(X[new], dtype=self.dtype)
+
+    def _reset_bounds(self, my_N):
+        """ reset the state of the bound-based pruning of the E-step
+        (params['prune']) for my_N local data points with a new K(n)
+
+        my_N : integer
+            number of local data points
+        """
+        self._bounds = {
+            # lower bound on the distance to the candidates outside of K(n)
+            'lower': np.full((my_N), -np.inf),
+            # E-step in which the bound of each data point was computed
+            'stamp': np.full((my_N), -1, dtype=np.int64),
+            # E-step from which each row of G_c is in use
+            'row_stamp': np.zeros((self.params['C']), dtype=np.int64),
+            'n_e_steps': 0,
+            'means': None,
+            'G_c': None,
+        }
+
+    def _stop_reason(self, free_energy, prev_free_energy, K_old, K, N):
+        """ check the stopping criteria after an EM iteration
+
+        Parameters
+        ----------
+        free_energy, prev_free_energy : float (prev_free_energy None
+            in the first iteration)
+            free energy after this and after the previous iteration
+
+        K_old, K : integer arrays, shape (my_N, Cprime)
+            process local index sets K(n) before and after the E-step
+
+        N : integer
+            number of data points of all processes
+
+        Returns
+        -------
+        stop_reason : string or None
+            the first criterion below its tolerance ('tol_fe', 'tol_K'
+            or 'tol_drift'), None if training continues
+        """
+        tol_fe, tol_K, tol_drift = self.params['tol_fe'], self.params['tol_K'], self.params['tol_drift']
+        if tol_fe is not None and prev_free_energy is not None:
+            change = abs(free_energy - prev_free_energy) / abs(prev_free_energy)
+            if change < tol_fe:
+                return 'tol_fe: relative free energy change {:.3e} < {}'.format(change, tol_fe)
+        # K(n) is fixed for Cprime == C
+        if tol_K is not None and self.params['Cprime'] < self.params['C']:
+            my_changed = np.count_nonzero(np.any(np.sort(K_old, axis=1) != np.sort(K, axis=1), axis=1))
+            changed = self.comm.allreduce(np.asarray(my_changed, dtype=np.int64)) / N
+            if changed < tol_K:
+                return 'tol_K: fraction of changed K(n) {:.3e} < {}'.format(changed, tol_K)
+        if tol_drift is not None:
+            # the means and therefore the drift agree on all processes
+            drift = np.max(self.drift)
+            if drift < tol_drift:
+                return 'tol_drift: maximal mean drift {:.3e} < {}'.format(drift, tol_drift)
+        return None
+
+    def _count_distevals(self, n):
+        """ add n distance evaluations to the count of this iteration
+        (the time needed for counting is not added to the training time)
+
+        n : integer
+            number of distance evaluations
+        """
+        self.training_time += timer() - self.start_time
+        self.ndistevals[self.n_iteration - 1] += n
+        self.start_time = timer()
+
     def _distribute(self, X):
         """Distribute data between processes
 
@@ -1379,32 +2219,47 @@ class TruncatedGaussianMixture(object):
         my_X : np-array, shape (~n_samples/n_processes, n_components)
             data for this process
         """
-        rank = self.comm.rank
-        size = self.comm.size
-        my_n = [i for i in range(X.shape[0]) if i * size // X.shape[0] == rank]
-        my_X = X[my_n]
+        my_X = np.asarray(X[self._my_rows(X.shape[0])], dtype=self.dtype)
         return my_X
 
-    def _idx_from_K(self, K):
-        """Index matrix to select the datapoints belonging to c out of K_n
+    def _my_rows(self, n_samples):
+        """ contiguous rows of the data points of this process
 
-        Parameters
-        ----------
-        K : array-like, shape (n_samples, Cprime)
-            Index set of non-zero entries.
+        Process p gets the rows ceil(p N / size) to ceil((p+1) N / size),
+        the partition is cached for the last n_samples.
+
+        n_samples : integer
+            number of data points N of all processes
 
         Returns
         -------
-        idx : numpy array, shape(C, n_samples)
+        rows : slice
         """
-        N = K.shape[0]
-        C = self.params['C']
+        if self._rows is None or self._rows[0] != n_samples:
+            rank, size = self.comm.rank, self.comm.size
+            self._rows = (n_samples, slice(-(-rank * n_samples // size), -(-(rank + 1) * n_samples // size)))
+        return self._rows[1]
+
+
+def _reduce_by_key(keys, values):
+    """Sum up the rows of values that share the same key
+
+    Parameters
+    ----------
+    keys : integer array, shape (n, )
 
-        # shape(cluster number,
-        idx = np.zeros((C, N), dtype=bool)
-        rows = np.arange(N).T
-        idx.T[rows[:, np.newaxis], K] = True
-        return idx
+    values : array-like, shape (n, m)
+
+    Returns
+    -------
+    unique_keys : numpy array, shape (n_unique, )
+
+    summed_values : numpy array, shape (n_unique, m)
+    """
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    summed_values = np.zeros((unique_keys.size, values.shape[1]), dtype=np.float64)
+    np.add.at(summed_values, inverse, values)
+    return unique_keys, summed_values
 
 
 def _softmax(p):
@@ -0,0 +1,388 @@
+from __future__ import division
+
+import os
+import pickle
+import sys
+import threading
+import traceback
+from timeit import default_timer as timer
+
+import numpy as np
+
+
+def _nbytes(obj):
+    """bytes of an array, or of a pickled object"""
+    if isinstance(obj, np.ndarray) or np.isscalar(obj):
+        return np.asarray(obj).nbytes
+    return len(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class Request(object):
+    """ Pending non-blocking reduction, see Communicator.iallreduce. """
+
+    def __init__(self, comm, wait=None, result=None):
+        self._comm = comm
+        self._wait = wait
+        self._result = result
+
+    def wait(self):
+        """Block until the reduction is complete and return its result"""
+        if self._wait is not None:
+            start = timer()
+            self._result, self._wait = self._wait(), None
+            self._comm.time += timer() - start
+        return self._result
+
+
+class Communicator(object):
+    """ Collective operations used by TruncatedGaussianMixture.
+
+    All collectives have to be called by all processes in the same
+    order. Arrays are exchanged as numpy arrays, reductions are sums.
+    The bytes sent by this process and the time spent in collectives
+    are accumulated in bytes_sent and time. Subclasses implement the
+    collectives in the underscore methods.
+    """
+    name = None
+    rank = 0
+    size = 1
+    bytes_sent = 0
+    time = 0.
+
+    def _account(self, collective, payload, *args):
+        start = timer()
+        result = collective(payload, *args)
+        self.time += timer() - start
+        self.bytes_sent += _nbytes(payload)
+        return result
+
+    def allreduce(self, array):
+        """Sum of array over all processes
+
+        Parameters
+        ----------
+        array : array-like (or scalar)
+            process local summand, same shape and dtype on all processes
+
+        Returns
+        -------
+        total : numpy array (numpy scalar for scalars), same shape and
+            dtype as array
+        """
+        return self._account(self._allreduce, array)
+
+    def iallreduce(self, array):
+        """Start the sum of array over all processes without waiting for
+        it (where the communicator supports it, otherwise the sum is
+        computed right away)
+
+        Returns
+        -------
+        request : Request
+            request.wait() returns the sum (see allreduce)
+        """
+        return self._account(self._iallreduce, array)
+
+    def _iallreduce(self, array):
+        return Request(self, result=self._allreduce(array))
+
+    def reduce(self, array, root=0):
+        """Sum of array over all processes on the root process (None
+        on all other processes)"""
+        total = self.allreduce(array)
+        return total if self.rank == root else None
+
+    def allgather(self, obj):
+        """List of the (picklable) objects of all processes, in rank order"""
+        return self._account(self._allgather, obj)
+
+    def allgatherv(self, array):
+        """Concatenation of the arrays of all processes along the first
+        axis, in rank order
+
+        Parameters
+        ----------
+        array : array-like, shape (n_rows, ...)
+            number of rows may differ between the processes; dtype and
+            the remaining dimensions must agree
+
+        Returns
+        -------
+        all_array : numpy array, shape (sum of n_rows, ...)
+        """
+        return self._account(self._allgatherv, array)
+
+    def bcast(self, obj, root=0):
+        """The (picklable) object of the root process"""
+        return self._account(self._bcast, obj if self.rank == root else None, root)
+
+    def barrier(self):
+        """Block until all processes reached the barrier"""
+        start = timer()
+        self._barrier_wait()
+        self.time += timer() - start
+
+
+class SerialCommunicator(Communicator):
+    """ Single process, all collectives are no-ops. """
+    name = 'serial'
+
+    def _allreduce(self, array):
+        return np.array(array, copy=True)[()]
+
+    def _allgather(self, obj):
+        return [obj]
+
+    def _allgatherv(self, array):
+        return np.array(array, copy=True)
+
+    def _bcast(self, obj, root=0):
+        return obj
+
+    def _barrier_wait(self):
+        pass
+
+
+class MPICommunicator(Communicator):
+    """ Collectives on an mpi4py communicator (MPI.COMM_WORLD by default). """
+    name = 'mpi'
+
+    def __init__(self, comm=None):
+        from mpi4py import MPI
+        self._MPI = MPI
+        self.comm = MPI.COMM_WORLD if comm is None else comm
+        self.rank = self.comm.rank
+        self.size = self.comm.size
+
+    def _allreduce(self, array):
+        array = np.asarray(array, order='C')
+        total = np.empty_like(array)
+        self.comm.Allreduce(array, total, op=self._MPI.SUM)
+        return total[()]
+
+    def _iallreduce(self, array):
+        # the buffers must stay alive until the request completes
+        buffers = (np.array(array, order='C', copy=True),)
+        buffers += (np.empty_like(buffers[0]),)
+        request = self.comm.Iallreduce(buffers[0], buffers[1], op=self._MPI.SUM)
+
+        def wait():
+            request.Wait()
+            return buffers[1][()]
+        return Request(self, wait=wait)
+
+    def _allgather(self, obj):
+        return self.comm.allgather(obj)
+
+    def _allgatherv(self, array):
+        array = np.asarray(array, order='C')
+        n_rows = self.comm.allgather(array.shape[0])
+        all_array = np.empty((sum(n_rows),) + array.shape[1:], dtype=array.dtype)
+        # exchange as bytes, the row size is the same on all processes
+        counts = np.asarray(n_rows) * array.itemsize * int(np.prod(array.shape[1:]))
+        displacements = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        self.comm.Allgatherv([array.reshape(-1).view(np.uint8), self._MPI.BYTE],
+                             [all_array.reshape(-1).view(np.uint8), counts, displacements, self._MPI.BYTE])
+        return all_array
+
+    def _bcast(self, obj, root=0):
+        return self.comm.bcast(obj, root=root)
+
+    def _barrier_wait(self):
+        self.comm.Barrier()
+
+
+class PoolCommunicator(Communicator):
+    """ Collectives between the local processes started by run_pool.
+
+    Each process owns one slot of a multiprocessing.shared_memory block.
+    A collective writes the local payload into the own slot, waits at a
+    barrier, copies the slots of all processes and waits again before
+    the slots are reused. Payloads larger than a slot are exchanged in
+    several rounds.
+    """
+    name = 'pool'
+
+    def __init__(self, rank, size, shm, barrier, slot_bytes):
+        self.rank = rank
+        self.size = size
+        self._shm = shm
+        self._barrier = barrier
+        self._slots = np.ndarray((size, slot_bytes), dtype=np.uint8, buffer=shm.buf)
+
+    def _exchange(self, payload):
+        """Exchange raw bytes between all processes
+
+        Parameters
+        ----------
+        payload : bytes-like
+
+        Returns
+        -------
+        received : list of numpy uint8 arrays
+            the payloads of all processes, in rank order
+        """
+        payload = np.frombuffer(payload, dtype=np.uint8)
+        slot = self._slots[self.rank]
+        capacity = slot.size - 8
+        received, sizes, start = None, None, 0
+        while True:
+            chunk = payload[start:start + capacity]
+            slot[:8] = np.frombuffer(np.int64(payload.size).tobytes(), dtype=np.uint8)
+            slot[8:8 + chunk.size] = chunk
+            self._barrier.wait()
+            if sizes is None:
+                sizes = [int(np.frombuffer(self._slots[r, :8].tobytes(), dtype=np.int64)[0])
+                         for r in range(self.size)]
+                received = [np.empty(n, dtype=np.uint8) for n in sizes]
+            for r in range(self.size):
+                n = min(capacity, max(sizes[r] - start, 0))
+                received[r][start:start + n] = self._slots[r, 8:8 + n]
+            self._barrier.wait()
+            start += capacity
+            if start >= max(sizes):
+                return received
+
+    def _allreduce(self, array):
+        array = np.asarray(array, order='C')
+        parts = self._exchange(array.tobytes())
+        total = np.zeros_like(array)
+        # sum in rank order, so that all processes get identical values
+        for part in parts:
+            total += np.frombuffer(part.tobytes(), dtype=array.dtype).reshape(array.shape)
+        return total[()]
+
+    def _allgather(self, obj):
+        parts = self._exchange(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+        return [pickle.loads(part.tobytes()) for part in parts]
+
+    def _allgatherv(self, array):
+        array = np.asarray(array, order='C')
+        parts = self._exchange(array.tobytes())
+        return np.frombuffer(b''.join(part.tobytes() for part in parts),
+                             dtype=array.dtype).reshape((-1,) + array.shape[1:]).copy()
+
+    def _bcast(self, obj, root=0):
+        payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL) if self.rank == root else b''
+        return pickle.loads(self._exchange(payload)[root].tobytes())
+
+    def _barrier_wait(self):
+        self._barrier.wait()
+
+    def close(self):
+        del self._slots
+        self._shm.close()
+
+
+def _pool_worker(target, rank, size, shm, barrier, slot_bytes, results, args, kwargs):
+    comm = PoolCommunicator(rank, size, shm, barrier, slot_bytes)
+    error = None
+    try:
+        target(comm, *args, **kwargs)
+    except threading.BrokenBarrierError:
+        # another process failed and reports its error
+        pass
+    except Exception:
+        barrier.abort()
+        error = traceback.format_exc()
+    finally:
+        comm.close()
+    results.put((rank, error))
+
+
+def run_pool(target, n_procs, *args, **kwargs):
+    """Run target(comm, *args, **kwargs) in n_procs local processes
+
+    The calling process takes rank 0, the other ranks are forked and
+    communicate through shared memory (see PoolCommunicator).
+
+    Parameters
+    ----------
+    target : callable
+        called with a PoolCommunicator as first argument by each process
+
+    n_procs : integer
+        number of processes
+
+    slot_bytes : integer (keyword, default: 2 ** 22)
+        shared memory per process and exchange round
+
+    Returns
+    -------
+    result : return value of target on rank 0
+    """
+    import multiprocessing
+    from multiprocessing import shared_memory
+
+    slot_bytes = kwargs.pop('slot_bytes', 2 ** 22)
+    context = multiprocessing.get_context('fork')
+    shm = shared_memory.SharedMemory(create=True, size=n_procs * slot_bytes)
+    barrier = context.Barrier(n_procs)
+    results = context.Queue()
+    processes = [context.Process(target=_pool_worker,
+                                 args=(target, rank, n_procs, shm, barrier, slot_bytes, results, args, kwargs))
+                 for rank in range(1, n_procs)]
+    try:
+        for process in processes:
+            process.start()
+        comm = PoolCommunicator(0, n_procs, shm, barrier, slot_bytes)
+        try:
+            result = target(comm, *args, **kwargs)
+        except threading.BrokenBarrierError:
+            broken = sys.exc_info()
+        except Exception:
+            barrier.abort()
+            raise
+        else:
+            broken = None
+        finally:
+            comm.close()
+        errors = [results.get() for _ in processes]
+        errors = ['rank {}:\n{}'.format(rank, error) for rank, error in sorted(errors) if error is not None]
+        if errors:
+            raise RuntimeError('run_pool: worker processes failed\n' + '\n'.join(errors))
+        if broken is not None:
+            raise broken[1]
+        return result
+    finally:
+        for process in processes:
+            process.join()
+        shm.close()
+        shm.unlink()
+
+
+def _launched_by_mpi():
+    """True if the process was started by mpiexec/mpirun with more than
+    one process (or mpi4py is already in use)"""
+    if 'mpi4py.MPI' in sys.modules:
+        return True
+    for variable in ['OMPI_COMM_WORLD_SIZE', 'PMI_SIZE', 'MPI_LOCALNRANKS']:
+        if int(os.environ.get(variable, 1)) > 1:
+            return True
+    return False
+
+
+def get_comm(comm=None):
+    """Communicator by name or from an mpi4py communicator
+
+    Parameters
+    ----------
+    comm : None, string, Communicator or mpi4py communicator
+        None or 'auto': MPI if the process was started by mpiexec,
+        serial otherwise (mpi4py is then not imported).
+        'mpi', 'serial': the respective communicator.
+        Communicators are returned unchanged, mpi4py communicators are
+        wrapped. Pool communicators are created by run_pool.
+
+    Returns
+    -------
+    comm : Communicator
+    """
+    if isinstance(comm, Communicator):
+        return comm
+    if comm is None or comm == 'auto':
+        comm = 'mpi' if _launched_by_mpi() else 'serial'
+    if not isinstance(comm, str):
+        return MPICommunicator(comm)
+    assert comm in ['mpi', 'serial'], "comm must be 'auto', 'mpi' or 'serial' (use run_pool for 'pool')"
+    return MPICommunicator() if comm == 'mpi' else SerialCommunicator()
@@ -2,6 +2,25 @@ import numpy as np
 import os
 import h5py
 
+from utils.comm import get_comm
+from utils.data import iter_chunks
+
+
+# rows : sorted, unique row indices, relative to start
+# returns data[start + rows], gathered by a single fancy index for numpy arrays (and memory maps),
+# otherwise (e.g. h5py Dataset, where fancy indexing is slow) by a streaming pass over the rows start to stop in n_chunks chunks
+def gather_rows(data, rows, start, stop, n_chunks, dtype=None):
+    if isinstance(data, np.ndarray):
+        return np.asarray(data[start + rows], dtype=dtype)
+    result = np.empty((rows.size,) + data.shape[1:], dtype=dtype)
+    first = 0
+    for chunk, data_chunk in iter_chunks(data, start, stop, n_chunks, dtype=dtype):
+        last = np.searchsorted(rows, chunk.stop)
+        result[first:last] = data_chunk[rows[first:last] - chunk.start]
+        first = last
+    return result
+
+
 class Coreset(object):
     dataset = None
     data = None
@@ -54,9 +73,14 @@ class Coreset(object):
         return self
 
     # size : the size of coreset
+    # chunk_rows : rows per chunk, the data (e.g. an h5py Dataset) is read in streaming passes over chunks
+    # comm : Communicator (see utils.comm), by default the coreset is built by a single process from all rows.
+    #        Otherwise each process reads only its contiguous rows (as TruncatedGaussianMixture._my_rows) and
+    #        keeps the part of the coreset sampled from them, fit it with fit_weight(..., distributed=True)
     # coreset_config : {'cluster' : cluster number, 'delta' : probability of coreset, 'epsilon' : error bounding}
-    def construct(self, size = 0, **coreset_config):
+    def construct(self, size = 0, chunk_rows = 2 ** 18, comm = None, **coreset_config):
         print("-------------------Constructing Coreset-------------------")
+        comm = get_comm('serial' if comm is None else comm)
         # the size of rows
         m = self.data.shape[0]
         print("Row size of data:", m)
@@ -73,56 +97,63 @@ class Coreset(object):
         else:
             print("size of coreset={} decide by user".format(size))
 
-        # store the sum of rows
-        u = np.zeros(n, dtype=np.float)
-        for row in self.data:
-            u += row
+        # rows of this process
+        start, stop = -(-comm.rank * m // comm.size), -(-(comm.rank + 1) * m // comm.size)
+        n_chunks = max(1, -(-(stop - start) // chunk_rows))
+
+        # first pass : the sum of rows
+        u = np.zeros(n, dtype=np.float64)
+        for _, chunk in iter_chunks(self.data, start, stop, n_chunks, dtype=np.float64):
+            u += np.sum(chunk, axis=0)
         # average -> mean
-        u *= 1.0 / m
+        u = comm.allreduce(u) * (1.0 / m)
         print("Average all rows : ", u)
 
-        # distance of each data point to mean
+        # second pass : distance of each data point to mean
         # q[i] = \sqrt{\sum ||x-u||^2} ^2 【quantization error】
-        q = np.zeros(m, dtype=np.float)
-
+        q = np.zeros(stop - start, dtype=np.float64)
+        for rows, chunk in iter_chunks(self.data, start, stop, n_chunks, dtype=np.float64):
+            q[rows] = np.sum(np.square(chunk - u), axis=1)
         # sum of all distance
-        sum = 0
-        for i in range(0, m):
-            s = 0
-            # \sum ||x-u||^2
-            for j in range(0, n):
-                s += self.data[i][j]**2 + u[j]**2 - 2*self.data[i][j]*u[j]
-            q[i] = s
-            sum += s
-        print("Sum all distance : ", sum)
+        total = comm.allreduce(np.sum(q))
+        print("Sum all distance : ", total)
 
         # get distribution function
-        for i in range(0, m):
-            q[i] = 0.5 * (q[i] / sum + 1.0 / m)
+        q = 0.5 * (q / total + 1.0 / m)
         print("Compute distribution of all data points")
 
         # distribution sampling : draw ‘size' from 'm' data
         # the index of samples
-        samplei = np.random.choice(m, size, p=q)
+        if comm.size == 1:
+            samplei = np.random.choice(m, size, p=q)
+        else:
+            # the number of samples drawn from the rows of each process is
+            # multinomial with the probability mass of its rows, so the
+            # union is distributed as 'size' draws from all rows
+            mass = np.asarray(comm.allgather(np.sum(q)))
+            counts = comm.bcast(np.random.multinomial(size, mass / np.sum(mass)) if comm.rank == 0 else None)
+            if counts[comm.rank] > 0:
+                samplei = np.random.choice(stop - start, counts[comm.rank], p=q / mass[comm.rank])
+            else:
+                # no samples (possibly no rows) on this process
+                samplei = np.zeros(0, dtype=np.int64)
+            print("rank {}: {} of {} samples".format(comm.rank, counts[comm.rank], size))
         print("Choose points from dataset")
 
-        sample = np.zeros((0, n), dtype=np.float)
-        sample_label = np.zeros(size, dtype=np.int64)
-        weight = np.zeros(size, dtype=np.float)
+        # read each sampled row once, repeated rows are expanded afterwards
+        rows, inverse = np.unique(samplei, return_inverse=True)
         print("Start sampling from dataset")
+        sample = gather_rows(self.data, rows, start, stop, n_chunks, dtype=np.float64)[inverse]
         if self.label is not None:
             print("Samples with labels")
             # load labels from dataset
-            for i in range(0, size):
-                sample = np.row_stack((sample, self.data[samplei[i]]))
-                sample_label[i] = self.label[samplei[i]]
-                weight[i] = 1. / (size * q[samplei[i]])
+            label = self.label if hasattr(self.label, 'shape') else np.asarray(self.label)
+            sample_label = gather_rows(label, rows, start, stop, n_chunks, dtype=np.int64)[inverse]
         else:
             print("Samples without labels")
-            # not load labels from dataset
-            for i in range(0, size):
-                sample = np.row_stack((sample, self.data[samplei[i]]))
-                weight[i] = 1. / (size * q[samplei[i]])
+            sample_label = np.zeros(samplei.size, dtype=np.int64)
+        # weights of the coreset of all processes
+        weight = 1. / (size * q[samplei])
         print("End sampling")
 
         print("-------------------Construction Finished-------------------")
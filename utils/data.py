@@ -1,16 +1,19 @@
 from __future__ import division
 from builtins import range
 
+import hashlib
+import os
+
 import numpy as np
-from mpi4py import MPI
 import matplotlib
 import matplotlib.pyplot as plt
 import pylab
-import utils.coreset as cs
+from utils.comm import get_comm
 
 
-def get_data(dataset, comm=MPI.COMM_WORLD):
+def get_data(dataset, comm=None):
     print("Get data from dataset:", dataset)
+    comm = get_comm(comm)
     rank = comm.rank
     fig = None
     means_gt = None
@@ -149,7 +152,7 @@ def get_data(dataset, comm=MPI.COMM_WORLD):
                 h5file.create_dataset('train/data', data=X)
                 h5file.create_dataset('train/label', data=Y)
                 h5file.close()
-        comm.Barrier()
+        comm.barrier()
         # Read h5 file
         h5file = h5py.File(dataset_name + '.h5', 'r')  # name, read-only file
 
@@ -175,9 +178,13 @@ def get_data(dataset, comm=MPI.COMM_WORLD):
         gt_values = {'means': means_gt, 'sigma_sq': sigma_sq_gt}
 
     elif dataset == 'KDD':
-        X = np.loadtxt('./datasets/KDD2004/bio_train.dat')[:, 3:]
-        Y = np.loadtxt('./datasets/KDD2004/bio_train.dat')[:, 2]
         dataset_name = dataset
+        import h5py
+        ingest_text('./datasets/KDD2004/bio_train.dat', dataset_name + '.h5', label_column=2,
+                    features=slice(3, None), delimiter=None, comm=comm)
+        h5file = h5py.File(dataset_name + '.h5', 'r')
+        X = h5file['train/data']
+        Y = h5file['train/label'][()]
         parameters = {
             'dataset': dataset,
             'D': X.shape[1],
@@ -282,20 +289,11 @@ def get_data(dataset, comm=MPI.COMM_WORLD):
 
     elif dataset == 'SUSY':
         dataset_name = dataset
-        import os.path
         import h5py
-        if os.path.isfile(dataset_name + '.h5'):
-            h5file = h5py.File(dataset_name + '.h5', 'r')
-            X = h5file['train/data'].value
-            Y = h5file['train/label'].value
-        else:
-            data = np.genfromtxt('./datasets/SUSY/SUSY.csv', delimiter=",")
-            X = data[:, 1:]
-            Y = data[:, 0]
-            h5file = h5py.File(dataset_name + '.h5', 'w')
-            h5file.create_dataset('train/data', data=X)
-            h5file.create_dataset('train/label', data=Y)
-            h5file.close()
+        ingest_text('./datasets/SUSY/SUSY.csv', dataset_name + '.h5', comm=comm)
+        h5file = h5py.File(dataset_name + '.h5', 'r')
+        X = h5file['train/data']
+        Y = h5file['train/label'][()]
         gt_values = None
         parameters = {
             'dataset': dataset,
@@ -305,10 +303,12 @@ def get_data(dataset, comm=MPI.COMM_WORLD):
         }
 
     elif dataset == 'SONG':
-        data = np.genfromtxt('./datasets/SONG/YearPredictionMSD.txt', delimiter=",")
-        X = data[:, 1:]
-        Y = data[:, 0]
         dataset_name = dataset
+        import h5py
+        ingest_text('./datasets/SONG/YearPredictionMSD.txt', dataset_name + '.h5', comm=comm)
+        h5file = h5py.File(dataset_name + '.h5', 'r')
+        X = h5file['train/data']
+        Y = h5file['train/label'][()]
         parameters = {
             'dataset': dataset,
             'D': X.shape[1],
@@ -334,3 +334,215 @@ def get_data(dataset, comm=MPI.COMM_WORLD):
         pass
 
     return X, Y, parameters, gt_values
+
+
+def iter_chunks(X, start, stop, n_chunks, dtype=None):
+    """Iterate over the rows X[start:stop] in n_chunks contiguous chunks
+
+    The next chunk is read on a background thread while the current one
+    is processed, so that reading from an HDF5 dataset (or a memory map)
+    overlaps with computation. Only two chunks are held in memory.
+
+    Parameters
+    ----------
+    X : array-like, shape (n_samples, n_features)
+        e.g. an h5py Dataset, supporting X[a:b]
+
+    start, stop : integer
+        rows of the (process local) part of X
+
+    n_chunks : integer
+        number of chunks (at most stop - start)
+
+    dtype : numpy dtype or None
+        the chunks are converted to dtype
+
+    Yields
+    ------
+    rows : slice
+        rows of the chunk, relative to start
+
+    X_chunk : numpy array, shape (rows, n_features)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    bounds = [start + i * (stop - start) // n_chunks for i in range(n_chunks + 1)]
+
+    def read(i):
+        return np.asarray(X[bounds[i]:bounds[i + 1]], dtype=dtype)
+
+    with ThreadPoolExecutor(1) as executor:
+        future = executor.submit(read, 0)
+        for i in range(n_chunks):
+            X_chunk = future.result()
+            if i + 1 < n_chunks:
+                future = executor.submit(read, i + 1)
+            yield slice(bounds[i] - start, bounds[i + 1] - start), X_chunk
+
+
+def load_text(path, delimiter=None, comm=None, cache_dir=None):
+    """Text data set as a read-only memory map, parsed only once
+
+    The first call parses the text file with np.loadtxt and saves it as
+    .npy file in cache_dir; later calls open the .npy file with
+    np.load(mmap_mode='r'). The cache file is keyed by the path, the
+    modification time and the size of the text file (and the delimiter),
+    so it is rebuilt when the text file changes. Older cache files of
+    the same text file are removed.
+
+    Parameters
+    ----------
+    path : string
+        text file with one data point per row
+
+    delimiter : string or None
+        column delimiter passed to np.loadtxt (None: whitespace)
+
+    comm : Communicator or None
+        only process 0 parses the text file (see utils.comm.get_comm)
+
+    cache_dir : string or None
+        directory of the cache files (default: '.cache' next to the
+        text file)
+
+    Returns
+    -------
+    data : numpy memmap, shape (n_samples, n_columns)
+    """
+    comm = get_comm(comm)
+    path = os.path.abspath(path)
+    cache_dir = os.path.join(os.path.dirname(path), '.cache') if cache_dir is None else cache_dir
+    key = _source_key(path, delimiter)
+    prefix = os.path.basename(path) + '.'
+    cache = os.path.join(cache_dir, prefix + key + '.npy')
+
+    if comm.rank == 0 and not os.path.isfile(cache):
+        print("Convert {} to {}".format(path, cache))
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        data = np.loadtxt(path, delimiter=delimiter, ndmin=2)
+        # write to a temporary file first, so that an interrupted
+        # conversion does not leave a truncated cache file
+        tmp = cache[:-4] + '.{}.tmp.npy'.format(os.getpid())
+        np.save(tmp, data)
+        os.replace(tmp, cache)
+        for name in os.listdir(cache_dir):
+            if name.startswith(prefix) and name.endswith('.npy') and name != os.path.basename(cache) \
+                    and '.tmp.' not in name:
+                os.remove(os.path.join(cache_dir, name))
+    comm.barrier()
+    return np.load(cache, mmap_mode='r')
+
+
+def _source_key(path, *extra):
+    """Hash of the path, the modification time and the size of a file
+    (and of extra), identifies derived cache files"""
+    path = os.path.abspath(path)
+    status = os.stat(path)
+    return hashlib.sha1(repr((path, status.st_mtime_ns, status.st_size) + extra).encode()).hexdigest()[:16]
+
+
+def _parse_piece(path, start, stop, delimiter, label_column, features):
+    """Features and labels of the lines in the bytes [start, stop) of a text file"""
+    import io
+    with open(path, 'rb') as file:
+        file.seek(start)
+        piece = file.read(stop - start)
+    data = np.loadtxt(io.BytesIO(piece), delimiter=delimiter, ndmin=2)
+    return data[:, features], data[:, label_column]
+
+
+def ingest_text(path, h5_path, label_column=0, features=slice(1, None), delimiter=',', n_procs=None,
+                piece_bytes=2 ** 26, comm=None):
+    """Convert a large text data set into a chunked HDF5 file
+
+    The text file is split on line boundaries into pieces of about
+    piece_bytes bytes, which are parsed by a pool of n_procs processes.
+    Features and labels are read in the same pass and appended in file
+    order to the datasets 'train/data' and 'train/label' of h5_path. The
+    HDF5 file stores a key of the text file (path, modification time,
+    size and the column selection) and is only rebuilt if it changes.
+
+    Parameters
+    ----------
+    path : string
+        text file with one data point per row
+
+    h5_path : string
+        HDF5 file to write
+
+    label_column : integer
+        column of the labels
+
+    features : slice
+        columns of the features
+
+    delimiter : string or None
+        column delimiter passed to np.loadtxt (None: whitespace)
+
+    n_procs : integer or None
+        number of parsing processes (default: number of CPUs)
+
+    piece_bytes : integer
+        approximate size of the pieces of the text file
+
+    comm : Communicator or None
+        only process 0 converts the text file (see utils.comm.get_comm)
+
+    Returns
+    -------
+    h5_path : string
+    """
+    import h5py
+    from concurrent.futures import ProcessPoolExecutor
+
+    comm = get_comm(comm)
+    key = _source_key(path, delimiter, label_column, features.start, features.stop, features.step)
+
+    def is_current():
+        if not os.path.isfile(h5_path):
+            return False
+        with h5py.File(h5_path, 'r') as h5file:
+            return h5file.attrs.get('source_key') == key
+
+    if comm.rank == 0 and not is_current():
+        print("Ingest {} into {}".format(path, h5_path))
+        # piece boundaries at the line starts following multiples of piece_bytes
+        size = os.path.getsize(path)
+        bounds = [0]
+        with open(path, 'rb') as file:
+            for offset in range(piece_bytes, size, piece_bytes):
+                if offset <= bounds[-1]:
+                    continue
+                file.seek(offset)
+                file.readline()
+                if file.tell() < size:
+                    bounds.append(file.tell())
+        bounds.append(size)
+
+        # write to a temporary file first, so that an interrupted
+        # conversion does not leave an incomplete HDF5 file
+        tmp = '{}.{}.tmp'.format(h5_path, os.getpid())
+        n_procs = os.cpu_count() if n_procs is None else n_procs
+        with h5py.File(tmp, 'w') as h5file, ProcessPoolExecutor(n_procs) as executor:
+            data, label = None, None
+            pieces = executor.map(_parse_piece, [path] * (len(bounds) - 1), bounds[:-1], bounds[1:],
+                                  [delimiter] * (len(bounds) - 1), [label_column] * (len(bounds) - 1),
+                                  [features] * (len(bounds) - 1))
+            for X, Y in pieces:
+                if data is None:
+                    # chunks of about 1 MB of rows
+                    rows = max(1, 2 ** 20 // (8 * max(1, X.shape[1])))
+                    data = h5file.create_dataset('train/data', shape=(0, X.shape[1]), maxshape=(None, X.shape[1]),
+                                                 chunks=(rows, X.shape[1]), dtype=np.float64)
+                    label = h5file.create_dataset('train/label', shape=(0,), maxshape=(None,),
+                                                  chunks=(rows,), dtype=np.float64)
+                n = data.shape[0]
+                data.resize(n + X.shape[0], axis=0)
+                label.resize(n + X.shape[0], axis=0)
+                data[n:] = X
+                label[n:] = Y
+            h5file.attrs['source_key'] = key
+        os.replace(tmp, h5_path)
+    comm.barrier()
+    return h5_path
@@ -0,0 +1,294 @@
+from __future__ import division
+
+import threading
+import warnings
+
+import numpy as np
+
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:
+    numba = None
+
+
+class NumpyKernels(object):
+    """ Hot loops of the truncated E- and M-step, vectorized with numpy.
+
+    All kernels work on blocks of data points and on the padded
+    candidate matrices G_n (clusters per data point, -1 for padding).
+    """
+    name = 'numpy'
+
+    @staticmethod
+    def candidates(G_c, K, random_c):
+        """Union of the neighbors of the clusters in K(n)
+
+        Parameters
+        ----------
+        G_c : integer array, shape (C, G)
+            index set of cluster neighbors
+
+        K : integer array, shape (n_samples, Cprime)
+            index set K(n)
+
+        random_c : integer array, shape (n_samples, 0 or 1)
+            additional random cluster per data point
+
+        Returns
+        -------
+        G_n : integer numpy array, shape (n_samples, Cprime * G + 0 or 1)
+            sorted candidate clusters, duplicates replaced by -1
+        """
+        G_n = np.concatenate([G_c[K].reshape(K.shape[0], -1), random_c], axis=1)
+        G_n = np.sort(G_n, axis=1).astype(np.int32)
+        G_n[:, 1:][G_n[:, 1:] == G_n[:, :-1]] = -1
+        return G_n
+
+    @staticmethod
+    def candidate_sq_distances(X, means, K, means_sq, X_sq):
+        """Squared euclidean distances between data points and their candidate means
+
+        Parameters
+        ----------
+        X : array-like, shape (n_samples, n_features)
+            Input data.
+
+        means : array-like, shape (n_components, n_features)
+            Gaussian means.
+
+        K : integer array, shape (n_samples, W)
+            candidate clusters of each sample (entries < 0 are padding and
+            yield meaningless values)
+
+        means_sq : array-like, shape (n_components, )
+            squared norms of the means
+
+        X_sq : array-like, shape (n_samples, )
+            squared norms of the data points
+
+        Returns
+        -------
+        sq_distance : numpy array, shape (n_samples, W)
+        """
+        # batched matrix product (n, W, D) x (n, D, 1), in float64 like
+        # the squared norms (and the accumulation of the Numba kernel)
+        means = np.asarray(means, dtype=np.float64)
+        X = np.asarray(X, dtype=np.float64)
+        cross = np.matmul(means[K], X[:, :, np.newaxis])[:, :, 0]
+        sq_distance = X_sq[:, np.newaxis] - 2. * cross + means_sq[K]
+        return np.maximum(sq_distance, 0.)
+
+    @staticmethod
+    def top_candidates(G_n, G_n_log_joint_xc, Cprime):
+        """Select the Cprime candidates with the largest log-joints
+
+        Ties are broken in favour of the earlier candidate in G_n, so
+        that all backends select the same clusters.
+
+        Parameters
+        ----------
+        G_n : integer array, shape (n_samples, W)
+            candidate clusters
+
+        G_n_log_joint_xc : array-like, shape (n_samples, W)
+            log-joints of the candidates, -inf for the padding
+
+        Cprime : integer
+            |K(n)|
+
+        Returns
+        -------
+        K : integer numpy array, shape (n_samples, Cprime)
+
+        log_joint_xc : numpy array, shape (n_samples, Cprime)
+        """
+        top = np.argsort(-G_n_log_joint_xc, axis=1, kind='stable')[:, :Cprime]
+        rows = np.arange(G_n.shape[0])[:, np.newaxis]
+        return G_n[rows, top], G_n_log_joint_xc[rows, top]
+
+    @staticmethod
+    def sufficient_statistics(X, X_sq, K, resp, C):
+        """Sufficient statistics of the M-step for a block of data points
+
+        Parameters
+        ----------
+        X : array-like, shape (n_samples, n_features)
+            Input data.
+
+        X_sq : array-like, shape (n_samples, )
+            Squared norms of the data points.
+
+        K : integer array, shape (n_samples, Cprime)
+            Index set K(n).
+
+        resp : array-like, shape (n_samples, Cprime)
+            Posterior probabilities of the clusters in K(n), times the
+            weights of the data points for fit_weight.
+
+        C : integer
+            Number of clusters.
+
+        Returns
+        -------
+        sum_resp : numpy array, shape (C, )
+            summed responsibilities
+
+        sum_x : numpy array, shape (C, n_features)
+            responsibility weighted sum of the data points
+
+        sum_x2 : numpy array, shape (C, )
+            responsibility weighted sum of the squared norms of the data points
+        """
+        N, D = X.shape
+        # one weighted scatter (bincount) per statistic over the N * Cprime
+        # entries of K, accumulated in float64 also for float32 data
+        k = K.ravel().astype(np.intp)
+        r = np.asarray(resp, dtype=np.float64).ravel()
+        sum_resp = np.bincount(k, weights=r, minlength=C)
+        sum_x2 = np.bincount(k, weights=r * np.repeat(X_sq, K.shape[1]), minlength=C)
+        # responsibility weighted data points, scattered with the keys
+        # k * D + d for the D components of the data points
+        rows = np.repeat(np.arange(N), K.shape[1])
+        weighted_X = r[:, np.newaxis] * X[rows]
+        keys = (k[:, np.newaxis] * D + np.arange(D)).ravel()
+        sum_x = np.bincount(keys, weights=weighted_X.ravel(), minlength=C * D).reshape(C, D)
+        return sum_resp, sum_x, sum_x2
+
+
+if numba is not None:
+
+    @njit(parallel=True, nogil=True, cache=True)
+    def _numba_candidates(G_c, K, random_c):
+        N, Cprime = K.shape
+        G = G_c.shape[1]
+        R = random_c.shape[1]
+        W = Cprime * G + R
+        G_n = np.empty((N, W), dtype=np.int32)
+        for n in prange(N):
+            row = G_n[n]
+            i = 0
+            for j in range(Cprime):
+                for g in range(G):
+                    row[i] = G_c[K[n, j], g]
+                    i += 1
+            for j in range(R):
+                row[i] = random_c[n, j]
+                i += 1
+            row.sort()
+            for i in range(W - 1, 0, -1):
+                if row[i] == row[i - 1]:
+                    row[i] = -1
+        return G_n
+
+    @njit(parallel=True, nogil=True, cache=True)
+    def _numba_candidate_sq_distances(X, means, K, means_sq, X_sq):
+        N, W = K.shape
+        D = X.shape[1]
+        sq_distance = np.zeros((N, W), dtype=np.float64)
+        for n in prange(N):
+            for w in range(W):
+                c = K[n, w]
+                if c < 0:
+                    continue
+                cross = 0.
+                for d in range(D):
+                    cross += means[c, d] * X[n, d]
+                value = X_sq[n] - 2. * cross + means_sq[c]
+                sq_distance[n, w] = value if value > 0. else 0.
+        return sq_distance
+
+    @njit(parallel=True, nogil=True, cache=True)
+    def _numba_top_candidates(G_n, G_n_log_joint_xc, Cprime):
+        N, W = G_n.shape
+        K = np.empty((N, Cprime), dtype=np.int32)
+        log_joint_xc = np.empty((N, Cprime), dtype=G_n_log_joint_xc.dtype)
+        for n in prange(N):
+            taken = np.zeros(W, dtype=np.bool_)
+            for j in range(Cprime):
+                best = -1
+                for w in range(W):
+                    if taken[w]:
+                        continue
+                    if best < 0 or G_n_log_joint_xc[n, w] > G_n_log_joint_xc[n, best]:
+                        best = w
+                taken[best] = True
+                K[n, j] = G_n[n, best]
+                log_joint_xc[n, j] = G_n_log_joint_xc[n, best]
+        return K, log_joint_xc
+
+    @njit(nogil=True, cache=True)
+    def _numba_sufficient_statistics(X, X_sq, K, resp, C):
+        N, D = X.shape
+        sum_resp = np.zeros(C, dtype=np.float64)
+        sum_x = np.zeros((C, D), dtype=np.float64)
+        sum_x2 = np.zeros(C, dtype=np.float64)
+        for n in range(N):
+            for j in range(K.shape[1]):
+                c = K[n, j]
+                r = float(resp[n, j])
+                sum_resp[c] += r
+                sum_x2[c] += r * X_sq[n]
+                for d in range(D):
+                    sum_x[c, d] += r * X[n, d]
+        return sum_resp, sum_x, sum_x2
+
+
+class NumbaKernels(NumpyKernels):
+    """ The kernels of NumpyKernels compiled with Numba, with the loops
+    over data points running in parallel (prange) and without holding
+    the GIL.
+
+    Numba's default threading layer must not be entered by several
+    threads at once, so calls to the parallel kernels are serialized by
+    a lock; blocks of other threads proceed with their numpy work.
+    """
+    name = 'numba'
+    _lock = threading.Lock()
+
+    @staticmethod
+    def candidates(G_c, K, random_c):
+        with NumbaKernels._lock:
+            return _numba_candidates(np.ascontiguousarray(G_c), np.ascontiguousarray(K),
+                                     np.ascontiguousarray(random_c))
+
+    @staticmethod
+    def candidate_sq_distances(X, means, K, means_sq, X_sq):
+        with NumbaKernels._lock:
+            return _numba_candidate_sq_distances(np.ascontiguousarray(X), np.ascontiguousarray(means),
+                                                 np.ascontiguousarray(K), means_sq, np.ascontiguousarray(X_sq))
+
+    @staticmethod
+    def top_candidates(G_n, G_n_log_joint_xc, Cprime):
+        with NumbaKernels._lock:
+            return _numba_top_candidates(G_n, G_n_log_joint_xc, Cprime)
+
+    @staticmethod
+    def sufficient_statistics(X, X_sq, K, resp, C):
+        return _numba_sufficient_statistics(np.ascontiguousarray(X), np.ascontiguousarray(X_sq),
+                                            np.ascontiguousarray(K), np.ascontiguousarray(resp), C)
+
+
+def get_backend(name='numpy'):
+    """Kernel backend by name
+
+    Parameters
+    ----------
+    name : string
+        'numpy' or 'numba'. If Numba is not installed 'numba' falls back
+        to 'numpy' with a warning.
+
+    Returns
+    -------
+    kernels : NumpyKernels or NumbaKernels
+    """
+    assert name in ['numpy', 'numba'], "backend must be 'numpy' or 'numba'"
+    if name == 'numba':
+        if numba is not None:
+            # launch Numba's worker threads from the main thread; when they
+            # are first launched from a thread of the E-step pool the
+            # interpreter hangs at exit
+            numba.get_num_threads()
+            return NumbaKernels
+        warnings.warn("Numba is not installed, falling back to the numpy backend.")
+    return NumpyKernels